@@ -0,0 +1,226 @@
+#
+# Asyncio indexing engine
+# An alternative to the threaded EventLane where a single event loop keeps
+# many events in flight.  The workspace, Elasticsearch and Docker clients
+# are all blocking, so each event is awaited on an executor thread with its
+# own IndexerUtils.  Events for the same object are chained so they still
+# run in order, without tying the object to a particular worker, and
+# workspace events wait for (and are waited on by) the workspace's objects.
+#
+from confluent_kafka import Consumer
+from concurrent.futures import ThreadPoolExecutor
+from IndexRunner.IndexerUtils import IndexerUtils
+from IndexRunner.EventUtils import Intake, _log_error
+from IndexRunner.WorkspaceGate import is_workspace_event
+from IndexRunner.OffsetTracker import OffsetTracker, OffsetCommitter
+from IndexRunner.FlowControl import FlowControl
+from IndexRunner.ConfigUtils import get_int, get_float, get_str, get_bool
+from IndexRunner.ErrorSink import error_sink, configure_error_sink
+import asyncio
+import logging
+
+
+class AsyncEngine:
+
+    def __init__(self, config, topics):
+        server = config.get('kafka-server', 'kafka')
+        cgroup = config.get('kafka-clientgroup', 'search_indexer')
+        self.concurrency = get_int(config, 'async-concurrency', 100)
+        self.batch_size = get_int(config, 'kafka-batch-size', 100)
+        self.batch_timeout = get_float(config, 'kafka-batch-timeout', 0.5)
+        commit_count = get_int(config, 'kafka-commit-count', 500)
+        commit_interval = get_float(config, 'kafka-commit-interval', 5.0)
+        max_inflight = get_int(config, 'kafka-max-inflight', 1000)
+        resume_inflight = get_int(config, 'kafka-resume-inflight', None)
+        self.log = logging.getLogger('indexrunner')
+        self.loop = asyncio.get_event_loop()
+
+        # Each executor thread checks out an indexer for the event it runs.
+        # The indexers share one producer and Elasticsearch client, which
+        # are thread safe, and the producer sends the retries too.
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.poller = ThreadPoolExecutor(max_workers=1)
+        self.indexers = asyncio.Queue()
+        # Every executor thread can have a request open on the shared
+        # Elasticsearch client, so its pool needs a connection for each
+        if get_str(config, 'es-maxsize') is None:
+            config = dict(config, **{'es-maxsize': str(self.concurrency)})
+        first = IndexerUtils(config)
+        self.indexers.put_nowait(first)
+        for i in range(self.concurrency - 1):
+            self.indexers.put_nowait(IndexerUtils(config, es=first.es,
+                                                  ep=first.ep))
+        self.retries = None
+        if get_str(config, 'kafka-retry-topic') is not None:
+            self.retries = first.ep
+        self.tails = dict()
+        # Each workspace's object events in flight and last workspace event
+        self.objects = dict()
+        self.barriers = dict()
+        self.tasks = set()
+        self.closed = False
+
+        self.tracker = OffsetTracker()
+        self.intake = Intake(config, self.tracker, self._finished)
+        self.consumer = Consumer({
+            'bootstrap.servers': server,
+            'group.id': cgroup,
+            'auto.offset.reset': 'earliest',
+            'enable.auto.commit': False
+        })
+        self.committer = OffsetCommitter(self.consumer, self.tracker,
+                                         commit_count=commit_count,
+                                         commit_interval=commit_interval)
+        self.flow = FlowControl(self.consumer, high_water=max_inflight,
+                                low_water=resume_inflight)
+        self.log.info("Async engine: topics %s, %d in flight" %
+                      (','.join(topics), self.concurrency))
+        self.consumer.subscribe(topics, on_revoke=self.committer.on_revoke)
+
+    def _finished(self, records):
+        for r in records:
+            self.tracker.done(*r[:3])
+
+    def _consume(self):
+        return self.consumer.consume(self.batch_size, self.batch_timeout)
+
+    async def _process(self, record, prevs):
+        """
+        Wait for the events this one has to follow, then process it on the
+        executor.
+        """
+        data = record[3]
+        delivered = True
+        try:
+            if len(prevs) > 0:
+                await asyncio.wait(prevs)
+            indexer = await self.indexers.get()
+            failed = []
+            try:
+                ok = await self.loop.run_in_executor(
+                    self.executor, indexer.process_event, data)
+                if ok is False:
+                    failed = [(data, 'Indexing failed')]
+            except Exception as e:
+                _log_error(data, e)
+                self.log.error('Uncaught exception: ' + str(e))
+                failed = [(data, e)]
+            finally:
+                self.indexers.put_nowait(indexer)
+            # The offset is committed once this is done, so wait for the
+            # retry to be delivered
+            if self.retries is not None and len(failed) > 0:
+                delivered = await self.loop.run_in_executor(
+                    self.executor, self.retries.retry_events, failed)
+        finally:
+            if delivered:
+                self.tracker.done(*record[:3])
+            else:
+                # Left in flight so the event is consumed again on restart
+                self.log.error("Retry of %s/%d/%d wasn't delivered" %
+                               record[:3])
+
+    def _dispatch(self, key, record):
+        """
+        An object event follows the previous one for the object, a
+        workspace event all of the workspace's events so far, and either
+        follows the last workspace event.
+        """
+        wsid = record[3]['accgrp']
+        barrier = is_workspace_event(record[3])
+        if barrier:
+            prevs = list(self.objects.pop(wsid, []))
+        else:
+            prevs = [self.tails[key]] if key in self.tails else []
+        if wsid in self.barriers:
+            prevs.append(self.barriers[wsid])
+        task = self.loop.create_task(self._process(record, prevs))
+        self.tasks.add(task)
+        if barrier:
+            self.barriers[wsid] = task
+        else:
+            self.tails[key] = task
+            self.objects.setdefault(wsid, set()).add(task)
+
+        def finished(t):
+            self.tasks.discard(t)
+            if self.tails.get(key) is t:
+                del self.tails[key]
+            if self.barriers.get(wsid) is t:
+                del self.barriers[wsid]
+            running = self.objects.get(wsid)
+            if running is not None:
+                running.discard(t)
+                if len(running) == 0:
+                    del self.objects[wsid]
+        task.add_done_callback(finished)
+
+    async def run(self, run_one=False):
+        try:
+            await self._run(run_one)
+        except BaseException:
+            # Interrupted (e.g. SIGTERM), so don't wait for running events
+            self.close(discard=True)
+            raise
+        self.close()
+
+    async def _run(self, run_one):
+        while True:
+            msgs = await self.loop.run_in_executor(self.poller, self._consume)
+            # Debouncing, held retries and coalescing work as in EventLane
+            for (key, record) in self.intake.take(msgs, drain=run_one):
+                self._dispatch(key, record)
+            self.committer.maybe_commit()
+            self.flow.update(self.tracker.inflight())
+            # This is just used in testing
+            if run_one:
+                break
+        if len(self.tasks) > 0:
+            await asyncio.wait(list(self.tasks))
+
+    def close(self, discard=False):
+        """
+        Commit the completed offsets and stop.  Safe to call more than once.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.executor.shutdown(wait=not discard)
+        self.poller.shutdown(wait=not discard)
+        if self.retries is not None:
+            self.retries.flush()
+        self.committer.commit(asynchronous=False)
+        self.consumer.close()
+        error_sink().flush()
+
+
+def async_watcher(config):
+    """
+    Drop-in replacement for kafka_watcher that runs the asyncio engine.
+    Lanes aren't supported; every topic is consumed together.
+    """
+    if get_str(config, 'kafka-lanes', 'none') != 'none':
+        raise ValueError("kafka-lanes isn't supported by the asyncio engine")
+    topic = config.get('kafka-topic', 'wsevents')
+    indexer_topic = config.get('kafka-index-topic', 'idxevents')
+    topics = [topic, indexer_topic]
+    retry_topic = get_str(config, 'kafka-retry-topic')
+    if retry_topic is not None:
+        topics.append(retry_topic)
+    run_one = 'run_one' in config
+    configure_error_sink(config)
+    if get_bool(config, 'es-bulk', False):
+        # Events are processed one at a time, each flushing its own writes
+        logging.getLogger('indexrunner').warning(
+            "es-bulk has no effect with the asyncio engine")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = AsyncEngine(config, topics)
+    try:
+        loop.run_until_complete(engine.run(run_one))
+    except BaseException:
+        # The interrupt can arrive outside of run()
+        engine.close(discard=True)
+        raise
+    finally:
+        loop.close()
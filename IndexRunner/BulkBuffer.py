@@ -0,0 +1,100 @@
+#
+# Elasticsearch bulk buffer
+# Collect the document writes of many events and send them in one bulk
+# request once enough actions or bytes are waiting or the oldest has waited
+# long enough.  Each action remembers the event it came from so failed
+# items can be reported against that event.
+#
+from elasticsearch.helpers import streaming_bulk
+from IndexRunner.ConfigUtils import get_int, get_float
+from time import time
+import json
+import logging
+
+# Weakest to strongest
+_REFRESH = ['false', 'wait_for', 'true']
+
+
+class BulkBuffer:
+
+    def __init__(self, es, max_actions=500, max_bytes=5 * 1024 * 1024,
+                 max_latency=1.0):
+        self.log = logging.getLogger('indexrunner')
+        self.es = es
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.actions = []
+        self.owners = []
+        self.size = 0
+        self.oldest = None
+        self.refresh = 'false'
+        self.errors = []
+
+    @classmethod
+    def from_config(cls, es, config):
+        return cls(es, max_actions=get_int(config, 'es-bulk-actions', 500),
+                   max_bytes=get_int(config, 'es-bulk-bytes', 5242880),
+                   max_latency=get_float(config, 'es-bulk-latency', 1.0))
+
+    def __len__(self):
+        return len(self.actions)
+
+    def add(self, action, owner=None, refresh='false'):
+        """
+        Queue a bulk helper action (_op_type, _index, _type, _id, _source
+        and so on) for owner, usually the event being processed.  The
+        request is sent with the strongest refresh of the actions in it.
+        """
+        self.actions.append(action)
+        self.owners.append(owner)
+        self.size += len(json.dumps(action.get('_source'), default=str))
+        if _REFRESH.index(refresh) > _REFRESH.index(self.refresh):
+            self.refresh = refresh
+        if self.oldest is None:
+            self.oldest = time()
+        self.maybe_flush()
+
+    def due(self):
+        if len(self.actions) == 0:
+            return False
+        return len(self.actions) >= self.max_actions or \
+            self.size >= self.max_bytes or \
+            time() - self.oldest >= self.max_latency
+
+    def maybe_flush(self):
+        if self.due():
+            self.send()
+
+    def send(self):
+        """
+        Send whatever is waiting, keeping any failures for flush.
+        """
+        if len(self.actions) == 0:
+            return
+        (actions, owners, refresh) = (self.actions, self.owners, self.refresh)
+        self.actions = []
+        self.owners = []
+        self.size = 0
+        self.oldest = None
+        self.refresh = 'false'
+        # One request for the lot; failures come back per item
+        results = streaming_bulk(self.es, actions, chunk_size=len(actions),
+                                 max_chunk_bytes=2 ** 31,
+                                 raise_on_error=False,
+                                 raise_on_exception=False, refresh=refresh)
+        for (owner, (ok, item)) in zip(owners, results):
+            if not ok:
+                self.errors.append((owner, item))
+        self.log.debug("Bulk wrote %d actions" % (len(actions)))
+
+    def flush(self):
+        """
+        Send whatever is waiting.  Returns the (owner, item) pairs for the
+        actions that failed since the last flush.
+        """
+        self.send()
+        (errors, self.errors) = (self.errors, [])
+        for (owner, item) in errors:
+            self.log.error("Bulk write failed: %s" % (str(item)))
+        return errors
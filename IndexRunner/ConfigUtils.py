@@ -0,0 +1,35 @@
+#
+# Helpers for reading typed values out of the flat config dictionary.
+# Everything in the deploy config arrives as a string and unset template
+# values arrive as empty strings.
+#
+
+
+def get_str(config, key, default=None):
+    val = config.get(key)
+    if val is None or val == '':
+        return default
+    return val
+
+
+def get_int(config, key, default=None):
+    val = get_str(config, key)
+    if val is None:
+        return default
+    return int(val)
+
+
+def get_float(config, key, default=None):
+    val = get_str(config, key)
+    if val is None:
+        return default
+    return float(val)
+
+
+def get_bool(config, key, default=False):
+    val = get_str(config, key)
+    if val is None:
+        return default
+    if isinstance(val, bool):
+        return val
+    return str(val).lower() in ['1', 'true', 'yes', 'on']
@@ -0,0 +1,82 @@
+#
+# Debounce queue for high churn object types
+# Events for types with a quiet period in the mapping file are held back
+# until the object has gone quiet, and only the last one is indexed.  The
+# same queue holds retried events until their backoff has passed.
+#
+from time import time
+import yaml
+
+
+class Debouncer:
+
+    def __init__(self, periods, max_wait=300):
+        """
+        periods maps an object type to its quiet period in seconds.  An
+        object that never goes quiet is still released max_wait seconds
+        after its first held event.
+        """
+        self.periods = periods
+        self.max_wait = max_wait
+        self.held = dict()
+
+    @classmethod
+    def from_mapfile(cls, mapfile, max_wait=300):
+        with open(mapfile) as f:
+            d = yaml.load(f.read())
+        return cls(d.get('debounce') or dict(), max_wait=max_wait)
+
+    def __len__(self):
+        return len(self.held)
+
+    def wants(self, evt):
+        return evt['evtype'] == 'NEW_VERSION' and \
+            evt.get('objtype') in self.periods
+
+    def offer(self, key, item, evt, now=None):
+        """
+        Hold item under key.  Returns the item it replaced, if any, which
+        the caller should treat as finished.
+        """
+        if now is None:
+            now = time()
+        period = self.periods[evt['objtype']]
+        replaced = None
+        first = now
+        if key in self.held:
+            (replaced, first, release) = self.held[key]
+        release = min(now + period, first + self.max_wait)
+        self.held[key] = (item, first, release)
+        return replaced
+
+    def hold(self, key, item, release_at):
+        """
+        Hold item until a fixed time, e.g. a retry's backoff.  Unlike offer
+        nothing is replaced, so key should be unique.
+        """
+        self.held[key] = (item, release_at, release_at)
+
+    def release(self, key):
+        """
+        Stop holding key and return its item (or None).  Used when some
+        other event for the object has to go through in order.
+        """
+        if key not in self.held:
+            return None
+        return self.held.pop(key)[0]
+
+    def ready(self, now=None):
+        """
+        Return a list of (key, item) pairs whose quiet period is over.
+        """
+        if now is None:
+            now = time()
+        keys = [k for (k, h) in self.held.items() if h[2] <= now]
+        keys.sort(key=lambda k: self.held[k][2])
+        return [(k, self.held.pop(k)[0]) for k in keys]
+
+    def drain(self):
+        """
+        Release everything that is being held.
+        """
+        return self.ready(now=float('inf'))
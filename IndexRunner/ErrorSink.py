@@ -0,0 +1,166 @@
+#
+# Buffered error log
+# Failures are queued in memory as JSON records and written out in batches
+# by a background thread, so a failure storm doesn't turn into a file open
+# and write per event.  The log is rotated by size and tracebacks are only
+# captured up to a fixed rate.  If the file can't be written the buffer is
+# capped and the newest records are dropped.
+#
+from IndexRunner.ConfigUtils import get_str, get_int, get_float
+from threading import Lock, Thread, Event
+from time import time
+import json
+import logging
+import os
+import traceback
+
+
+def _jsonable(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    return str(obj)
+
+
+class ErrorSink:
+
+    def __init__(self, path='error.log', max_bytes=10 * 1024 * 1024,
+                 backups=3, flush_interval=1.0, traceback_rate=10,
+                 max_buffer=10000):
+        """
+        traceback_rate is the number of tracebacks kept per minute; past
+        that, records are written without one.  max_buffer is the most
+        records held waiting to be written.
+        """
+        self.log = logging.getLogger('indexrunner')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.traceback_rate = traceback_rate
+        self.max_buffer = max_buffer
+        # lock guards the buffer and counters, io_lock the file
+        self.lock = Lock()
+        self.io_lock = Lock()
+        self.buffer = []
+        self.dropped = 0
+        self.tb_window = 0
+        self.tb_count = 0
+        self.suppressed = 0
+        self.wakeup = Event()
+        self.thread = None
+
+    def write(self, event, error, index=None, module=None, duration=None,
+              exc_info=None):
+        """
+        Queue an error record.  index is the mapping entry (or its name)
+        the failure happened in and exc_info a sys.exc_info() tuple.
+        """
+        if isinstance(index, dict):
+            if module is None and 'index_method' in index:
+                module = index['index_method'].split('.')[0]
+            index = index.get('index_name')
+        rec = {
+            'time': time(),
+            'event': event,
+            'index': index,
+            'module': module,
+            'duration': duration,
+            'error': str(error),
+            'error_type': type(error).__name__
+        }
+        if exc_info is not None and exc_info[0] is not None and \
+                self._allow_traceback():
+            rec['traceback'] = ''.join(traceback.format_exception(*exc_info))
+        line = json.dumps(rec, default=_jsonable)
+        with self.lock:
+            if len(self.buffer) >= self.max_buffer:
+                self.dropped += 1
+            else:
+                self.buffer.append(line)
+            if self.thread is None:
+                self.thread = Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _allow_traceback(self):
+        now = time()
+        with self.lock:
+            if now - self.tb_window >= 60:
+                self.tb_window = now
+                self.tb_count = 0
+            if self.tb_count >= self.traceback_rate:
+                self.suppressed += 1
+                return False
+            self.tb_count += 1
+            return True
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.log.error("Writing %s failed: %s" % (self.path, str(e)))
+
+    def flush(self):
+        """
+        Write out the buffered records.  The file is written outside of the
+        buffer's lock so write() never waits on it.
+        """
+        with self.io_lock:
+            with self.lock:
+                (lines, self.buffer) = (self.buffer, [])
+                (dropped, self.dropped) = (self.dropped, 0)
+            if dropped > 0:
+                lines.append(json.dumps({'time': time(), 'dropped': dropped}))
+            if len(lines) == 0:
+                return
+            try:
+                with open(self.path, 'a') as f:
+                    f.write('\n'.join(lines))
+                    f.write('\n')
+            except Exception:
+                # Put them back for the next try, within the cap
+                with self.lock:
+                    room = max(self.max_buffer - len(self.buffer), 0)
+                    self.dropped += max(len(lines) - room, 0)
+                    self.buffer[:0] = lines[:room]
+                raise
+            if self.max_bytes > 0 and \
+                    os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        if self.backups < 1:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.path, i + 1))
+        os.replace(self.path, self.path + '.1')
+
+
+_sink = ErrorSink()
+
+
+def error_sink():
+    """
+    Return the process wide error sink.
+    """
+    return _sink
+
+
+def configure_error_sink(config):
+    """
+    Apply the error-log settings from the config to the shared sink.
+    """
+    _sink.flush()
+    _sink.path = get_str(config, 'error-log', 'error.log')
+    _sink.max_bytes = get_int(config, 'error-log-max-bytes', 10 * 1024 * 1024)
+    _sink.backups = get_int(config, 'error-log-backups', 3)
+    _sink.flush_interval = get_float(config, 'error-log-flush-interval', 1.0)
+    _sink.traceback_rate = get_int(config, 'error-traceback-rate', 10)
+    _sink.max_buffer = get_int(config, 'error-log-max-buffer', 10000)
+    return _sink
@@ -0,0 +1,172 @@
+#
+# Workspace event
+# A compact, slotted replacement for the decoded JSON dictionary.  It keeps
+# dictionary style access so the rest of the runner can treat it like the
+# plain dict it used to be, but the object's upa and elastic id are worked
+# out once when the event is decoded.
+#
+import json
+
+try:
+    import orjson as _fastjson
+except ImportError:
+    try:
+        import ujson as _fastjson
+    except ImportError:
+        _fastjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_FIELDS = ('strcde', 'accgrp', 'objid', 'ver', 'newname', 'evtype', 'time',
+           'objtype', 'objtypever', 'public')
+_DERIVED = ('upa', 'eid')
+_IDENTITY = ('accgrp', 'objid', 'ver')
+_MISSING = object()
+
+# Messages that aren't JSON say so with a content type header
+CONTENT_TYPE = 'content-type'
+MSGPACK = 'application/msgpack'
+
+
+def loads(raw):
+    """
+    Decode JSON bytes with the fastest parser available.
+    """
+    if _fastjson is not None:
+        return _fastjson.loads(raw)
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    return json.loads(raw)
+
+
+def content_type(headers):
+    """
+    Return the content type from a message's headers, or None for JSON.
+    """
+    if headers is None:
+        return None
+    for (key, value) in headers:
+        if key == CONTENT_TYPE:
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            return value
+    return None
+
+
+def encode(data, encoding='json'):
+    """
+    Encode an event dictionary for Kafka.  Returns the message value and
+    its headers (None for plain JSON).
+    """
+    if encoding == 'msgpack':
+        return (msgpack.packb(data, use_bin_type=True),
+                [(CONTENT_TYPE, MSGPACK.encode('utf-8'))])
+    return json.dumps(data).encode('utf-8'), None
+
+
+class Event:
+    """
+    Anything outside the standard event fields (retry bookkeeping and so
+    on) is kept in a small side dictionary.
+    """
+    __slots__ = _FIELDS + _DERIVED + ('extra',)
+
+    def __init__(self, data):
+        # The fields every event needs; missing ones raise KeyError here
+        # rather than somewhere down in the indexer.
+        self.strcde = data['strcde']
+        self.accgrp = data['accgrp']
+        self.evtype = data['evtype']
+        self.objid = data.get('objid')
+        self.ver = data.get('ver')
+        self.newname = data.get('newname')
+        self.time = data.get('time')
+        self.objtype = data.get('objtype')
+        self.objtypever = data.get('objtypever')
+        self.public = data.get('public')
+        self.extra = None
+        for k, v in data.items():
+            if k not in _FIELDS and k not in _DERIVED:
+                self[k] = v
+        self._set_ids()
+        if 'upa' in data and data['upa'] is not None:
+            self['upa'] = data['upa']
+
+    @classmethod
+    def decode(cls, raw, headers=None):
+        ctype = content_type(headers)
+        if ctype == MSGPACK:
+            if msgpack is None:
+                raise ValueError("msgpack isn't installed")
+            return cls(msgpack.unpackb(raw, raw=False))
+        elif ctype is not None:
+            raise ValueError("Unknown content type " + ctype)
+        return cls(loads(raw))
+
+    def _set_ids(self):
+        if self.ver and self.objid is not None:
+            self.upa = '%d/%s/%d' % (self.accgrp, self.objid, self.ver)
+            self.eid = 'WS:%d:%s:%d' % (self.accgrp, self.objid, self.ver)
+        else:
+            self.upa = None
+            self.eid = None
+
+    def __getitem__(self, key):
+        if key in _FIELDS or key in _DERIVED:
+            return getattr(self, key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'upa':
+            self.upa = value
+            self.eid = None
+            if value is not None:
+                self.eid = 'WS:%s' % (value.replace('/', ':'))
+        elif key in _FIELDS:
+            setattr(self, key, value)
+            if key in _IDENTITY:
+                self._set_ids()
+        elif key == 'eid':
+            self.eid = value
+        else:
+            if self.extra is None:
+                self.extra = dict()
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in _FIELDS:
+            return True
+        if key in _DERIVED:
+            return getattr(self, key) is not None
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        keys = [k for k in _FIELDS]
+        keys.extend(k for k in _DERIVED if getattr(self, k) is not None)
+        if self.extra is not None:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def to_dict(self):
+        return {k: self[k] for k in self.keys()}
+
+    def copy(self):
+        return Event(self.to_dict())
+
+    def __eq__(self, other):
+        if isinstance(other, Event):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return repr(self.to_dict())
@@ -0,0 +1,79 @@
+#
+# Event coalescing
+# Collapse a window of workspace events down to its net effect so that
+# redundant events never reach the indexer.
+#
+_INDEX_EVENTS = ['NEW_VERSION', 'NEW_ALL_VERSIONS']
+_REINDEX_EVENTS = ['REINDEX_WORKSPACE', 'COPY_ACCESS_GROUP']
+
+
+def _identity(item):
+    return item
+
+
+def _supersedes(later, evt):
+    """
+    Return True if indexing later makes indexing evt unnecessary.
+    """
+    if later['evtype'] == 'NEW_ALL_VERSIONS' or \
+            evt['evtype'] == 'NEW_ALL_VERSIONS':
+        return True
+    return evt['ver'] <= later['ver']
+
+
+def coalesce(items, event=None):
+    """
+    Reduce a window of events to the ones that still matter.  items is
+    any list; event extracts the event dictionary from an item (the item
+    itself by default).  Returns (kept, dropped), both in the original
+    order.
+
+    The rules are:
+     - Only the latest version of an object is indexed.
+     - Objects deleted later in the window (and not undeleted) aren't
+       indexed.  The same goes for every object in a workspace that is
+       deleted later in the window.
+     - Only the last publish/unpublish of a workspace is kept.  Publishing
+       reads the current workspace state so the final event wins anyway.
+     - Only the last reindex/copy of a workspace (from the same starting
+       object, for the same type and index) is kept.
+    """
+    if event is None:
+        event = _identity
+    keep = [True] * len(items)
+    obj_state = dict()
+    ws_state = dict()
+    latest = dict()
+    seen = set()
+    # Walk backwards so the latest event for each object is seen first
+    for i in reversed(range(len(items))):
+        evt = event(items[i])
+        etype = evt['evtype']
+        ws = evt['accgrp']
+        obj = (ws, evt['objid'])
+        if etype in _INDEX_EVENTS:
+            if obj_state.get(obj) == 'deleted' or \
+                    ws_state.get(ws) == 'deleted':
+                keep[i] = False
+            elif obj in latest:
+                keep[i] = not _supersedes(latest[obj], evt)
+            else:
+                latest[obj] = evt
+        elif 'PUBLISH' in etype or etype in _REINDEX_EVENTS:
+            # A partial or targeted reindex only replaces the same one
+            kind = 'publish' if 'PUBLISH' in etype else \
+                ('reindex', evt.get('start', 0), evt.get('objtype'),
+                 evt.get('index'))
+            if (ws, kind) in seen:
+                keep[i] = False
+            seen.add((ws, kind))
+        elif etype.startswith('DELETE_') or etype.startswith('UNDELETE_'):
+            # Only the latest delete/undelete decides the final state
+            state = 'deleted' if etype.startswith('DELETE_') else 'restored'
+            if etype.endswith('_ACCESS_GROUP'):
+                ws_state.setdefault(ws, state)
+            else:
+                obj_state.setdefault(obj, state)
+    kept = [items[i] for i in range(len(items)) if keep[i]]
+    dropped = [items[i] for i in range(len(items)) if not keep[i]]
+    return kept, dropped
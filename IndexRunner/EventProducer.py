@@ -3,21 +3,115 @@
 # This waits for events and dispatches it to the indexer
 #
 from confluent_kafka import Producer
-import json
+from IndexRunner.ConfigUtils import get_str, get_int, get_float, get_bool
+from IndexRunner.RateLimiter import shared_rate_limiter
+from IndexRunner.Event import encode, msgpack
+from threading import Lock, local
+from time import time
 import logging
 
 
 class EventProducer():
 
     def __init__(self, config):
-        self.topic = config.get('kafka-index-topic', 'wsevents')
+        self.topic = config.get('kafka-index-topic', 'idxevents')
+        self.retry_topic = get_str(config, 'kafka-retry-topic')
+        self.dlq_topic = get_str(config, 'kafka-dlq-topic')
+        self.max_attempts = get_int(config, 'retry-max-attempts', 5)
+        self.backoff = get_float(config, 'retry-backoff', 30)
+        # When blocking is off index_objects doesn't wait for delivery;
+        # callers flush with checkpoint() instead.
+        self.blocking = get_bool(config, 'kafka-producer-blocking', True)
+        self.delivered = 0
+        self.failed = 0
+        # Threads can share a producer, so each checkpoints its own events
+        self.lock = Lock()
+        self.local = local()
+        self.limiter = shared_rate_limiter(config)
+        # Events are keyed so a workspace (or object) sticks to a partition
+        self.key_by = get_str(config, 'kafka-index-key', 'workspace')
+        self.encoding = get_str(config, 'kafka-encoding', 'json')
         server = config.get('kafka-server', 'kafka')
         config = config
         self.log = logging.getLogger('indexrunner')
+        if self.encoding == 'msgpack' and msgpack is None:
+            raise ValueError("kafka-encoding is msgpack but msgpack isn't "
+                             "installed")
         if server is not None:
-            self.prod = Producer({'bootstrap.servers': server})
+            self.prod = Producer({
+                'bootstrap.servers': server,
+                'linger.ms': get_int(config, 'kafka-linger-ms', 50),
+                'batch.num.messages':
+                    get_int(config, 'kafka-producer-batch', 10000),
+                'compression.codec':
+                    get_str(config, 'kafka-compression', 'lz4')
+            })
 
-    def index_objects(self, objects, public=False):
+    def _on_delivery(self, err, msg):
+        with self.lock:
+            if err is None:
+                self.delivered += 1
+                return
+            self.failed += 1
+        self.log.error("Failed to deliver event to %s: %s" %
+                       (msg.topic(), str(err)))
+
+    def _failures(self):
+        """
+        The calling thread's count of failed deliveries since its last
+        checkpoint.
+        """
+        if not hasattr(self.local, 'failed'):
+            self.local.failed = [0]
+        return self.local.failed
+
+    def _key(self, evt):
+        if self.key_by == 'object':
+            return ('%s/%s' % (evt['accgrp'], evt['objid'])).encode('utf-8')
+        elif self.key_by == 'workspace':
+            return str(evt['accgrp']).encode('utf-8')
+        return None
+
+    def _produce(self, topic, evt, on_delivery=None):
+        """
+        Encode and queue an event, waiting for room if the local queue is
+        full.  on_delivery is called with the delivery result of this event.
+        """
+        (data, headers) = encode(evt, self.encoding)
+        failed = self._failures()
+
+        def deliver(err, msg):
+            self._on_delivery(err, msg)
+            if err is not None:
+                with self.lock:
+                    failed[0] += 1
+            if on_delivery is not None:
+                on_delivery(err, msg)
+        args = {'key': self._key(evt), 'on_delivery': deliver}
+        if headers is not None:
+            args['headers'] = headers
+        while True:
+            try:
+                self.prod.produce(topic, data, **args)
+                break
+            except BufferError:
+                self.prod.poll(0.5)
+        # Serve delivery callbacks
+        self.prod.poll(0)
+
+    def object_events(self, objects, public=False, wsinfo=None, index=None):
+        """
+        Build an index event for each object info tuple.  The tuple goes
+        into the event, along with the workspace's flags if wsinfo is given,
+        so the indexer doesn't have to look them up again.  If index is set
+        the object is only indexed into that index.
+        """
+        wsflags = None
+        if wsinfo is not None:
+            public = wsinfo['public']
+            wsflags = {'public': wsinfo['public'], 'temp': wsinfo['temp'],
+                       'shared': wsinfo['shared']}
+        events = []
         for obj in objects:
             (objtype, objtypever) = obj[2].split('-')
             evt = {
@@ -30,8 +124,103 @@ class EventProducer():
                 'time': obj[3],
                 'objtype': objtype,
                 'objtypever': objtypever,
-                'public': public
+                'public': public,
+                'info': obj
                 }
-            data = json.dumps(evt)
-            self.prod.produce(self.topic, data.encode('utf-8'))
+            if wsflags is not None:
+                evt['wsflags'] = wsflags
+            if index is not None:
+                evt['index'] = index
+            events.append(evt)
+        return events
+
+    def index_objects(self, objects, public=False, wsinfo=None, index=None):
+        for evt in self.object_events(objects, public=public, wsinfo=wsinfo,
+                                      index=index):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            self._produce(self.topic, evt)
+        if self.blocking:
+            self.prod.flush()
+
+    def reindex_workspace(self, wsid, start=0, objtype=None, index=None):
+        """
+        Produce a REINDEX_WORKSPACE event for the workspace's objects from
+        object id start on, optionally only objects of one type and only
+        into one index.
+        """
+        evt = {
+            'strcde': 'WS',
+            'accgrp': wsid,
+            'objid': None,
+            'ver': None,
+            'newname': None,
+            'evtype': 'REINDEX_WORKSPACE',
+            'time': None,
+            'objtype': objtype,
+            'objtypever': None,
+            'public': None,
+            'start': start
+            }
+        if index is not None:
+            evt['index'] = index
+        self._produce(self.topic, evt)
+
+    def retry_event(self, evt, error, on_delivery=None):
+        """
+        Republish a failed event to the retry topic with an attempt count and
+        the time it may be retried, backing off exponentially.  Once it has
+        used up its attempts it goes to the dead letter topic instead.
+        on_delivery is passed on to _produce.
+        """
+        evt = dict(evt)
+        attempt = evt.get('attempt', 0) + 1
+        evt['error'] = str(error)
+        if attempt > self.max_attempts or self.retry_topic is None:
+            if self.dlq_topic is None:
+                coords = (evt.get('accgrp'), evt.get('objid'), evt.get('ver'))
+                if self.retry_topic is None:
+                    self.log.error("No retry topic configured, dropping "
+                                   "failed event %s/%s/%s: %s" %
+                                   (coords + (error,)))
+                else:
+                    self.log.error("Dropping failed event %s/%s/%s after %d "
+                                   "attempts: %s" %
+                                   (coords + (attempt - 1, error)))
+                return
+            topic = self.dlq_topic
+        else:
+            evt['attempt'] = attempt
+            evt['retry_at'] = time() + self.backoff * 2 ** (attempt - 1)
+            topic = self.retry_topic
+        self._produce(topic, evt, on_delivery=on_delivery)
+
+    def flush(self):
+        self.prod.flush()
+
+    def retry_events(self, failed):
+        """
+        Retry a list of (event, error) pairs and wait for them to be
+        delivered.  Returns False if any of them weren't.
+        """
+        errors = []
+
+        def delivered(err, msg):
+            if err is not None:
+                errors.append(err)
+        for (evt, err) in failed:
+            self.retry_event(evt, err, on_delivery=delivered)
+        self.prod.flush()
+        return len(errors) == 0
+
+    def checkpoint(self):
+        """
+        Wait for everything queued so far to be delivered.  Returns the
+        number of messages this thread produced that failed since its last
+        checkpoint.
+        """
         self.prod.flush()
+        failed = self._failures()
+        with self.lock:
+            (count, failed[0]) = (failed[0], 0)
+        return count
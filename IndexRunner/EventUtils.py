@@ -3,15 +3,291 @@
 # This waits for events and dispatches it to the indexer
 #
 from confluent_kafka import Consumer, KafkaError
-import json
+from IndexRunner.Event import Event
 from IndexRunner.IndexerUtils import IndexerUtils
+from IndexRunner.EventProducer import EventProducer
+from IndexRunner.OffsetTracker import OffsetTracker, OffsetCommitter
+from IndexRunner.WorkerPool import WorkerPool
+from IndexRunner.WorkspaceGate import WorkspaceGate
+from IndexRunner.EventCoalescer import coalesce
+from IndexRunner.Debouncer import Debouncer
+from IndexRunner.FlowControl import FlowControl
+from IndexRunner.ConfigUtils import get_int, get_float, get_bool, get_str
+from IndexRunner.ErrorSink import error_sink, configure_error_sink
+from threading import Thread
+from time import time
 import logging
 
 
 def _log_error(event, error):
-    with open('error.log', 'a') as f:
-        f.write(str(event)+'\n')
-        f.write(str(error)+'\n')
+    error_sink().write(event, error)
+
+
+def _event_key(data):
+    """
+    Events for the same object must be processed in order, so they are
+    routed to workers by access group and object id.  Workspace events are
+    kept in order with their objects' by a WorkspaceGate.
+    """
+    return '%s/%s' % (data['accgrp'], data['objid'])
+
+
+def _decode(msg, log):
+    """
+    Decode a Kafka message into an event.  Returns None (after logging)
+    for anything that can't be processed.
+    """
+    data = None
+    try:
+        data = Event.decode(msg.value(), msg.headers())
+        if data['strcde'] != 'WS':
+            _log_error(data, 'Bad strcde')
+            log.warning("Unreconginized strcde")
+            return None
+        # Make sure the event can be routed to a worker
+        _event_key(data)
+        return data
+    except BaseException as e:
+        _log_error(data, e)
+        log.error('Uncaught exception: ' + str(e))
+        return None
+
+
+class Intake:
+    """
+    Turns polled messages into (worker key, record) pairs ready to be
+    processed, where a record is (topic, partition, offset, event).  Events
+    that are debounced or are retries that aren't due yet are held back.
+    Used by EventLane and AsyncEngine.
+    """
+
+    def __init__(self, config, tracker, finished):
+        """
+        finished is called with the records that are dropped without being
+        processed (debounced, coalesced or undecodable).
+        """
+        self.coalesce = get_bool(config, 'kafka-coalesce', False)
+        max_wait = get_float(config, 'debounce-max-wait', 300)
+        self.tracker = tracker
+        self.finished = finished
+        self.log = logging.getLogger('indexrunner')
+        if config.get('mapping-file') is not None:
+            self.debouncer = Debouncer.from_mapfile(config['mapping-file'],
+                                                    max_wait=max_wait)
+        else:
+            self.debouncer = Debouncer(dict())
+
+    def take(self, msgs, drain=False):
+        """
+        Return the batch of records to process for the polled messages.  If
+        drain is set, events held by the debouncer are released too.
+        """
+        batch = []
+        for msg in msgs:
+            if msg is None:
+                pass
+            elif msg.error():
+                if msg.error().code() != KafkaError._PARTITION_EOF:
+                    err = str(msg.error())
+                    _log_error('', err)
+                    self.log.error("Kafka error: " + err)
+            else:
+                coords = (msg.topic(), msg.partition(), msg.offset())
+                self.tracker.add(*coords)
+                data = _decode(msg, self.log)
+                if data is None:
+                    self.tracker.done(*coords)
+                    continue
+                key = _event_key(data)
+                record = coords + (data,)
+                if data.get('retry_at', 0) > time():
+                    # A retry that isn't due yet
+                    self.debouncer.hold('retry:%s/%d/%d' % coords, record,
+                                        data['retry_at'])
+                    continue
+                if self.debouncer.wants(data):
+                    replaced = self.debouncer.offer(key, record, data)
+                    if replaced is not None:
+                        self.finished([replaced])
+                    continue
+                # Anything held for this object has to go first
+                held = self.debouncer.release(key)
+                if held is not None:
+                    batch.append((key, held))
+                batch.append((key, record))
+        if drain:
+            ready = self.debouncer.drain()
+        else:
+            ready = self.debouncer.ready()
+        batch.extend((_event_key(r[3]), r) for (k, r) in ready)
+        if self.coalesce and len(batch) > 1:
+            (batch, dropped) = coalesce(batch, event=lambda b: b[1][3])
+            if len(dropped) > 0:
+                self.log.debug("Coalesced away %d events" % (len(dropped)))
+            self.finished([b[1] for b in dropped])
+        return batch
+
+
+class EventLane:
+    """
+    A consumer for a set of topics together with its own workers, offset
+    tracking and flow control.
+    """
+
+    def __init__(self, name, config, topics, nworkers, yield_to=None):
+        """
+        If yield_to is another lane, this lane stops fetching whenever that
+        lane has work in flight (strict priority).
+        """
+        server = config.get('kafka-server', 'kafka')
+        cgroup = config.get('kafka-clientgroup', 'search_indexer')
+        self.batch_size = get_int(config, 'kafka-batch-size', 1)
+        self.batch_timeout = get_float(config, 'kafka-batch-timeout', 0.5)
+        commit_count = get_int(config, 'kafka-commit-count', 500)
+        commit_interval = get_float(config, 'kafka-commit-interval', 5.0)
+        max_inflight = get_int(config, 'kafka-max-inflight', 1000)
+        resume_inflight = get_int(config, 'kafka-resume-inflight', None)
+        self.name = name
+        self.yield_to = yield_to
+        self.running = True
+        self.discard = False
+        self.log = logging.getLogger('indexrunner')
+
+        # Failed events are republished for a retry if a topic is set
+        self.retries = None
+        if get_str(config, 'kafka-retry-topic') is not None:
+            self.retries = EventProducer(config)
+
+        self.tracker = OffsetTracker()
+        # Records whose retries weren't delivered, which mustn't be committed
+        self.undelivered = set()
+        handlers = [self._make_handler(IndexerUtils(config))
+                    for i in range(nworkers)]
+        self.pool = WorkerPool(handlers, callback=self._processed)
+        self.gate = WorkspaceGate(event=lambda r: r[3])
+        self.intake = Intake(config, self.tracker, self._finished)
+
+        # Offsets are committed by hand and only once the message has been
+        # processed.
+        self.consumer = Consumer({
+            'bootstrap.servers': server,
+            'group.id': cgroup,
+            'auto.offset.reset': 'earliest',
+            'enable.auto.commit': False
+        })
+        self.committer = OffsetCommitter(self.consumer, self.tracker,
+                                         commit_count=commit_count,
+                                         commit_interval=commit_interval)
+        self.flow = FlowControl(self.consumer, high_water=max_inflight,
+                                low_water=resume_inflight)
+        self.log.info("Lane %s: topics %s, %d workers" %
+                      (name, ','.join(topics), nworkers))
+        self.consumer.subscribe(topics, on_revoke=self.committer.on_revoke)
+
+    def _make_handler(self, indexer):
+        def handle(records):
+            events = [r[3] for r in records]
+            failed = []
+            try:
+                if len(events) == 1:
+                    if indexer.process_event(events[0]) is False:
+                        failed = [(events[0], 'Indexing failed')]
+                else:
+                    failed = indexer.process_events(events)
+            except BaseException as e:
+                _log_error(events, e)
+                self.log.error('Uncaught exception: ' + str(e))
+                failed = [(evt, e) for evt in events]
+            # The offsets are committed once this returns, so wait for the
+            # retries to be delivered
+            if self.retries is not None and len(failed) > 0:
+                if not self.retries.retry_events(failed):
+                    self.undelivered.update(r[:3] for r in records)
+        return handle
+
+    def _submit(self, records):
+        if self.batch_size > 1:
+            self.pool.submit_many([(_event_key(r[3]), r) for r in records])
+        else:
+            for r in records:
+                self.pool.submit(_event_key(r[3]), [r])
+
+    def _processed(self, records):
+        # Start whatever was waiting on these before they count as done
+        self._submit(self.gate.done(records))
+        self._finished(records)
+
+    def _finished(self, records):
+        for r in records:
+            if r[:3] in self.undelivered:
+                # Left in flight so the event is consumed again on restart
+                self.undelivered.discard(r[:3])
+                self.log.error("Retry of %s/%d/%d wasn't delivered" % r[:3])
+                continue
+            self.tracker.done(*r[:3])
+
+    def busy(self):
+        """
+        True if the workers have events queued or running.  Events held by
+        the debouncer or waiting for a retry don't count.
+        """
+        return self.pool.pending() > 0
+
+    def step(self, drain=False):
+        """
+        Poll once and dispatch whatever came back.  If drain is set, events
+        held by the debouncer are released too.
+        """
+        if self.batch_size > 1:
+            msgs = self.consumer.consume(self.batch_size, self.batch_timeout)
+        else:
+            msgs = [self.consumer.poll(self.batch_timeout)]
+
+        batch = self.intake.take(msgs, drain=drain)
+        self._submit(self.gate.admit([r for (k, r) in batch]))
+        self.committer.maybe_commit()
+        hold = self.yield_to is not None and self.yield_to.busy()
+        self.flow.update(self.tracker.inflight(), hold=hold)
+
+    def run(self, run_one=False):
+        try:
+            while self.running:
+                self.step(drain=run_one)
+                # This is just used in testing
+                if run_one:
+                    break
+        except BaseException:
+            # Interrupted (e.g. SIGTERM), so don't start anything new
+            self.close(discard=True)
+            raise
+        self.close(discard=self.discard)
+
+    def stop(self, discard=False):
+        """
+        Stop after the current poll.  If discard is set (the process was
+        interrupted) queued work that hasn't started is dropped.
+        """
+        self.discard = discard
+        self.running = False
+
+    def close(self, discard=False):
+        self.pool.shutdown(discard=discard)
+        if self.retries is not None:
+            self.retries.flush()
+        self.committer.commit(asynchronous=False)
+        self.consumer.close()
+        error_sink().flush()
+
+
+def _lane_workers(config, nworkers):
+    """
+    Split the workers between the live and reindex lanes according to
+    kafka-lane-weights (live:reindex).  Each lane gets at least one.
+    """
+    weights = config.get('kafka-lane-weights') or '3:1'
+    (live, reindex) = [float(w) for w in weights.split(':')]
+    nlive = max(1, int(round(nworkers * live / (live + reindex))))
+    return nlive, max(1, nworkers - nlive)
 
 
 def kafka_watcher(config):
@@ -19,49 +295,53 @@ def kafka_watcher(config):
     indexer_topic = config.get('kafka-index-topic', 'idxevents')
     server = config.get('kafka-server', 'kafka')
     cgroup = config.get('kafka-clientgroup', 'search_indexer')
+    retry_topic = get_str(config, 'kafka-retry-topic')
+    nworkers = get_int(config, 'worker-threads', 1)
+    lanes = get_str(config, 'kafka-lanes', 'none')
     config = config
     log = logging.getLogger('indexrunner')
     log.info("Initializing EventHandler")
+    configure_error_sink(config)
+    if get_bool(config, 'es-bulk', False) and \
+            get_int(config, 'kafka-batch-size', 1) < 2:
+        # Each worker's buffer is flushed at the end of every batch
+        log.warning("es-bulk has no effect unless kafka-batch-size > 1")
     run_one = False
     if 'run_one' in config:
         run_one = True
-    indexer = IndexerUtils(config)
-    c = Consumer({
-        'bootstrap.servers': server,
-        'group.id': cgroup,
-        'auto.offset.reset': 'earliest'
-    })
     log.info("Starting consumer")
     log.info("Server %s" % (server))
     log.info("Group: %s" % (cgroup))
     log.info("Topic: %s" % (topic))
     log.info("Index Topic: %s" % (indexer_topic))
+    log.info("Retry Topic: %s" % (retry_topic))
+    retry_topics = []
+    if retry_topic is not None:
+        retry_topics = [retry_topic]
 
-    c.subscribe([topic, indexer_topic])
-
-    while True:
-        msg = c.poll(0.5)
+    if lanes == 'none':
+        EventLane('all', config, [topic, indexer_topic] + retry_topics,
+                  nworkers).run(run_one)
+        return
 
-        data = None
-        if msg is None:
-            pass
-        elif msg.error():
-            if msg.error().code() != KafkaError._PARTITION_EOF:
-                err = str(msg.error())
-                _log_error('', err)
-                log.error("Kafka error: " + err)
-        else:
-            try:
-                data = json.loads(msg.value().decode('utf-8'))
-                if data['strcde'] != 'WS':
-                    _log_error(data, 'Bad strcde')
-                    log.warning("Unreconginized strcde")
-                else:
-                    indexer.process_event(data)
-            except BaseException as e:
-                _log_error(data, e)
-                log.error('Uncaught exception: ' + str(e))
-            # This is just used in testing
-        if run_one:
-            break
-    c.close()
+    # Live workspace events and reindex events get their own consumers and
+    # workers so a reindex flood can't delay live edits.
+    (nlive, nreindex) = _lane_workers(config, nworkers)
+    live = EventLane('live', config, [topic], nlive)
+    yield_to = None
+    if lanes == 'strict':
+        yield_to = live
+    reindex = EventLane('reindex', config, [indexer_topic] + retry_topics,
+                        nreindex, yield_to=yield_to)
+    reindex_thread = Thread(target=reindex.run, args=[run_one])
+    reindex_thread.daemon = True
+    reindex_thread.start()
+    try:
+        live.run(run_one)
+    except BaseException:
+        # Interrupted, so the reindex lane mustn't work through its queue
+        reindex.stop(discard=True)
+        reindex_thread.join()
+        raise
+    reindex.stop()
+    reindex_thread.join()
@@ -0,0 +1,42 @@
+#
+# Backpressure for the Kafka consumer
+# Fetching is paused when too much work is in flight and resumed once it
+# drains.  The consumer keeps polling while paused so it stays in its group.
+#
+import logging
+
+
+class FlowControl:
+
+    def __init__(self, consumer, high_water=1000, low_water=None):
+        self.log = logging.getLogger('indexrunner')
+        self.consumer = consumer
+        self.high_water = high_water
+        if low_water is None:
+            low_water = high_water // 2
+        self.low_water = low_water
+        self.paused = False
+        self.assigned = None
+
+    def update(self, inflight, hold=False):
+        """
+        Pause or resume based on the number of in-flight messages.  If hold
+        is set fetching stays paused regardless (e.g. while a higher
+        priority lane is busy).  Call this once per poll loop.
+        """
+        if not self.paused and (hold or inflight >= self.high_water):
+            self.log.info("Pausing fetch: %d in flight" % (inflight))
+            self.paused = True
+            self.assigned = None
+        elif self.paused and not hold and inflight <= self.low_water:
+            self.log.info("Resuming fetch: %d in flight" % (inflight))
+            self.paused = False
+            self.consumer.resume(self.consumer.assignment())
+            return
+        if self.paused:
+            # Partitions assigned by a rebalance start out unpaused
+            assignment = self.consumer.assignment()
+            current = set((p.topic, p.partition) for p in assignment)
+            if current != self.assigned:
+                self.consumer.pause(assignment)
+                self.assigned = current
@@ -1,11 +1,15 @@
-from IndexRunner.WSAdminUtils import WorkspaceAdminUtil
+from IndexRunner.WSAdminUtils import WorkspaceAdminUtil, workspace_flags
 from IndexRunner.MethodRunner import MethodRunner
 from IndexRunner.EventProducer import EventProducer
+from IndexRunner.ErrorSink import error_sink
+from IndexRunner.Event import Event
+from IndexRunner.ConfigUtils import get_str, get_int, get_bool
+from IndexRunner.RefreshPolicy import RefreshPolicy
+from IndexRunner.BulkBuffer import BulkBuffer
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 from elasticsearch.helpers import bulk
 import os
 import sys
-import traceback
 
 from time import time
 import json
@@ -14,7 +18,6 @@ import logging
 
 # This is the interface that will process indexing
 BULK_MAX = 9
-_MAX_LIST = 10000
 
 
 class IndexerUtils:
@@ -36,21 +39,49 @@ class IndexerUtils:
         }}
         """
 
-    def __init__(self, config):
+    def __init__(self, config, es=None, ep=None):
+        """
+        es and ep are an Elasticsearch client and EventProducer to share
+        with other indexers instead of making new ones.
+        """
         self.log = logging.getLogger('indexrunner')
         self.ws = WorkspaceAdminUtil(config)
-        self.es = Elasticsearch([config['elastic-host']])
+        # The client's connection pool caps the requests it has open at once
+        self.es = es or Elasticsearch([config['elastic-host']],
+                                      maxsize=get_int(config, 'es-maxsize', 10))
         self.esbase = config['elastic-base']
         mapfile = config.get('mapping-file')
         self.log.info("Mapping File: %s" % (mapfile))
         self.mapping = self._read_mapfile(mapfile)
+        self.refresh = RefreshPolicy.from_config(config, self.mapping)
+        # The event being processed, the indexes to refresh at the end of
+        # the batch and those written to without a refresh since the last
+        self._event = None
+        self._to_refresh = set()
+        self._unrefreshed = set()
+        # Document writes can be buffered across events and sent in bulk
+        self.bulk = None
+        if get_bool(config, 'es-bulk', False):
+            self.bulk = BulkBuffer.from_config(self.es, config)
 
         if 'workspace-admin-token' in config:
             token = config['workspace-admin-token']
         else:
             token = os.environ.get('KB_AUTH_TOKEN')
         self.mr = MethodRunner(config, token=token)
-        self.ep = EventProducer(config)
+        self.ep = ep or EventProducer(config)
+        # In direct mode reindexes are indexed here, a page per event
+        self.reindex_mode = get_str(config, 'reindex-mode', 'kafka')
+        self.reindex_page = get_int(config, 'reindex-page-size', 1000)
+        self.reindex_batch = get_int(config, 'reindex-batch-size', 100)
+        self.skip_indexed = get_bool(config, 'reindex-skip-indexed', False)
+        self.list_chunk = get_int(config, 'reindex-list-chunk', 10000)
+        self.list_threads = get_int(config, 'reindex-list-threads', 4)
+        # Lookups shared across a batch (see process_events)
+        self._ws_cache = None
+        self._indexed = None
+        self._active_indexes = None
+        self._versions = None
         with open('specs/mapping.json') as f:
             d = f.read()
             self.mapping_spec = json.loads(d)
@@ -66,46 +97,373 @@ class IndexerUtils:
         return mapping
 
     def process_event(self, evt):
-
+        """
+        Process a single event.  Returns False if indexing failed for any
+        of the object's indexes, True otherwise.
+        """
+        self._event = evt
+        ok = False
+        try:
+            ok = self._process_event(evt)
+        finally:
+            self._event = None
+            # A batch writes and refreshes once at the end (see
+            # process_events)
+            if self._ws_cache is None:
+                if len(self._flush_writes()) > 0:
+                    ok = False
+                self._refresh_indexes()
+        return ok
+
+    def _process_event(self, evt):
         etype = evt['evtype']
         ws = evt['accgrp']
-        if evt['ver']:
+        # Decoded events work out their upa themselves
+        if evt['ver'] and not isinstance(evt, Event):
             evt['upa'] = '%d/%s/%d' % (evt['accgrp'], evt['objid'], evt['ver'])
         if etype in ['NEW_VERSION', 'NEW_ALL_VERSIONS']:
-            self.new_object_version(evt)
+            return self.new_object_version(evt)
         elif 'PUBLISH' in etype:
             self.publish(evt['accgrp'])
         elif etype.startswith('DELETE_'):
             self.delete(evt)
         elif etype == 'COPY_ACCESS_GROUP':
-            self._index_workspace(ws)
+            self._index_workspace(ws, start=evt.get('start', 0))
         elif etype == 'RENAME_ALL_VERSIONS':
             self.log.warning("Warning rename not implemented.")
         elif etype in ['REINDEX_WORKSPACE']:
-            # Pseudo event
-            self._index_workspace(ws)
+            # Pseudo event.  If it has an objtype only objects of that type
+            # are reindexed, and only into its index if it names one.
+            self._index_workspace(ws, start=evt.get('start', 0),
+                                  objtype=evt['objtype'],
+                                  index=evt.get('index'))
         else:
             self.log.error("Can't process evtype " + evt['evtype'])
+        return True
+
+    def process_events(self, events):
+        """
+        Process a batch of events in order.  Workspace info, the active
+        index list and the "already indexed" checks are looked up once for
+        the whole batch instead of once per event.  Returns a list of
+        (event, error) pairs for the events that failed.
+        """
+        # Direct reindexes run a batch from inside an event of an outer one
+        outer = (self._ws_cache, self._indexed, self._active_indexes,
+                 self._versions)
+        self._ws_cache = dict()
+        self._indexed = self._find_indexed(events)
+        self._versions = self._find_versions(events)
+        failed = []
+        try:
+            for evt in events:
+                try:
+                    if self.process_event(evt) is False:
+                        failed.append((evt, 'Indexing failed'))
+                except Exception as e:
+                    self.log.exception("Failed to process event: " + str(e))
+                    self._log_error(evt, None, e, exc_info=sys.exc_info())
+                    failed.append((evt, e))
+                if self.bulk is not None:
+                    self.bulk.maybe_flush()
+            # Buffered writes have to land before the batch counts as done
+            for (evt, err) in self._flush_writes():
+                if not any(evt is f[0] for f in failed):
+                    failed.append((evt, err))
+        finally:
+            self._refresh_indexes()
+            (self._ws_cache, self._indexed, self._active_indexes,
+             self._versions) = outer
+        return failed
+
+    def _refresh_arg(self, index, by_query=False):
+        """
+        Return the refresh argument for a write to index, going by the
+        refresh policy for the index and the current event.
+        """
+        policy = self.refresh.policy(index, self._event)
+        if policy == 'batch':
+            self._to_refresh.add(index)
+        refresh = RefreshPolicy.refresh_arg(policy, by_query=by_query)
+        if refresh == 'false':
+            self._unrefreshed.add(index)
+        return refresh
+
+    def _write(self, op, index, doc_type, eid, doc, **meta):
+        """
+        Create or index a document, through the bulk buffer if there is
+        one.  meta is passed on as is (parent, routing).
+        """
+        refresh = self._refresh_arg(index)
+        if self.bulk is None:
+            write = self.es.create if op == 'create' else self.es.index
+            return write(index=index, doc_type=doc_type, id=eid, body=doc,
+                         refresh=refresh, **meta)
+        action = {'_op_type': op, '_index': index, '_type': doc_type,
+                  '_id': eid, '_source': doc}
+        for (k, v) in meta.items():
+            action['_' + k] = v
+        self.bulk.add(action, owner=self._event, refresh=refresh)
+
+    def _send_writes(self):
+        """
+        Writes by query have to see the documents of the events before
+        them, so send the buffered ones and refresh the indexes that were
+        written to without a refresh.
+        """
+        if self.bulk is not None:
+            self.bulk.send()
+        self._to_refresh |= self._unrefreshed
+        self._refresh_indexes()
+
+    def _flush_writes(self):
+        """
+        Send the buffered writes.  Returns an (event, error) pair for each
+        event with a write that failed.
+        """
+        if self.bulk is None:
+            return []
+        failed = []
+        for (evt, item) in self.bulk.flush():
+            if any(evt is f[0] for f in failed):
+                continue
+            (op, res) = list(item.items())[0]
+            self._log_error(evt, res.get('_index'), res.get('error', item))
+            failed.append((evt, item))
+        return failed
+
+    def _refresh_indexes(self):
+        """
+        Refresh the indexes written to with the batch policy.
+        """
+        if len(self._to_refresh) == 0:
+            return
+        indexes = ','.join(sorted(self._to_refresh))
+        self._unrefreshed -= self._to_refresh
+        self._to_refresh = set()
+        try:
+            self.es.indices.refresh(index=indexes, ignore_unavailable=True)
+        except Exception as e:
+            self.log.warning("Refresh of %s failed: %s" % (indexes, str(e)))
+
+    def _find_indexed(self, events):
+        """
+        Check which of the batch's object versions are already in their
+        target indexes using a single mget.  Returns a dictionary of
+        (index, doc_type, id) to a found flag.
+        """
+        docs = []
+        for evt in events:
+            for (index, doc_type, eid) in self._index_keys(evt):
+                docs.append({'_index': index, '_type': doc_type, '_id': eid})
+        indexed = dict()
+        if len(docs) == 0:
+            return indexed
+        try:
+            res = self.es.mget(body={'docs': docs})
+        except Exception as e:
+            # Fall back to checking each document
+            self.log.warning("Batch lookup failed: " + str(e))
+            return indexed
+        for doc in res['docs']:
+            if 'error' in doc:
+                continue
+            key = (doc['_index'], doc['_type'], doc['_id'])
+            indexed[key] = doc.get('found', False)
+        return indexed
+
+    def _find_versions(self, events):
+        """
+        Look up the latest indexed version of each object the batch's
+        reindex events are for, with one msearch.  Returns a dictionary of
+        (index, wsid, objid) to the version (0 if there isn't one).
+        """
+        keys = []
+        body = []
+        for evt in events:
+            if 'info' not in evt or evt['evtype'] != 'NEW_VERSION':
+                continue
+            prefix = "WS:%d/%s" % (evt['accgrp'], evt['objid'])
+            for oindex in self._event_indexes(evt):
+                keys.append((oindex['index_name'], evt['accgrp'],
+                             evt['objid']))
+                body.append({'index': oindex['index_name'], 'type': 'data'})
+                body.append({'size': 0, 'query': {'bool': {'filter': [
+                                {'term': {'prefix': prefix}}]}},
+                             'aggs': {'latest': {'max': {'field': 'version'}}}})
+        versions = dict()
+        if len(keys) == 0:
+            return versions
+        try:
+            res = self.es.msearch(body=body)
+        except Exception as e:
+            # Fall back to checking each object
+            self.log.warning("Batch version lookup failed: " + str(e))
+            return versions
+        for (key, resp) in zip(keys, res['responses']):
+            if 'error' in resp:
+                continue
+            latest = resp['aggregations']['latest']['value']
+            versions[key] = max(versions.get(key, 0), int(latest or 0))
+        return versions
+
+    def _mark_version(self, index, wsid, objid, vers):
+        """
+        Note a version written in this batch, which a lookup can't see
+        until it has been sent and refreshed.
+        """
+        if self._versions is not None:
+            key = (index, wsid, objid)
+            self._versions[key] = max(self._versions.get(key, 0), int(vers))
+
+    def _index_keys(self, evt):
+        """
+        Return the (index, doc_type, id) of each document that shows a new
+        version event has been indexed.
+        """
+        if evt['evtype'] != 'NEW_VERSION' or not evt['ver']:
+            return []
+        eid = evt.get('eid')
+        if eid is None:
+            upa = '%d/%s/%d' % (evt['accgrp'], evt['objid'], evt['ver'])
+            eid = self._get_id(upa)
+        keys = []
+        for oindex in self._event_indexes(evt):
+            doc_type = 'access'
+            if 'raw' in oindex and oindex['raw']:
+                doc_type = 'data'
+            keys.append((oindex['index_name'], doc_type, eid))
+        return keys
 
-    def _index_workspace(self, wsid):
+    def _skip_indexed(self, objs, index=None):
+        """
+        Drop the listed objects whose version is already in every index it
+        belongs in, using one lookup for the page.
+        """
+        events = self.ep.object_events(objs, index=index)
+        indexed = self._find_indexed(events)
+        keep = []
+        for (obj, evt) in zip(objs, events):
+            for key in self._index_keys(evt):
+                if not indexed.get(key, False):
+                    keep.append(obj)
+                    break
+        if len(keep) < len(objs):
+            self.log.info("Skipping %d indexed objects" %
+                          (len(objs) - len(keep)))
+        return keep
+
+    def _is_indexed(self, index, doc_type, eid):
+        if self._indexed is not None and \
+                (index, doc_type, eid) in self._indexed:
+            return self._indexed[(index, doc_type, eid)]
+        res = self.es.get(index=index, doc_type=doc_type, id=eid, ignore=404)
+        return res.get('status') != 404 and res['found']
+
+    def _mark_indexed(self, index, doc_type, eid):
+        if self._indexed is not None:
+            self._indexed[(index, doc_type, eid)] = True
+
+    def _index_workspace(self, wsid, start=0, objtype=None, index=None):
         """
         List the workspace and generate an index event for each object.
         """
-        min = 0
-        while (True):
-            objs = self.ws.list_objects({'ids': [wsid], 'minObjectID': min})
-            self.ep.index_objects(objs)
-            if (len(objs) <= _MAX_LIST):
-                break
-            min = objs[-1][0] + 1
+        if self.reindex_mode == 'direct':
+            return self._index_workspace_direct(wsid, start, objtype, index)
+        wsinfo = self._get_ws_info(wsid)
+        params = dict()
+        if objtype is not None:
+            params['type'] = objtype
+        # Chunks of the workspace are listed in parallel
+        pages = self.ws.iter_pages(wsid, params, start=start,
+                                   max_objid=wsinfo['info'][4],
+                                   chunk_size=self.list_chunk,
+                                   threads=self.list_threads)
+        for objs in pages:
+            if self.skip_indexed:
+                objs = self._skip_indexed(objs, index)
+            self.ep.index_objects(objs, wsinfo=wsinfo, index=index)
+        # The workspace only counts as done once its events are delivered
+        failed = self.ep.checkpoint()
+        if failed > 0:
+            raise IOError("%d index events for workspace %s weren't "
+                          "delivered" % (failed, wsid))
+
+    def _index_workspace_direct(self, wsid, start, objtype=None, index=None):
+        """
+        Index one page of the workspace here instead of sending an event per
+        object through Kafka.  The rest of the workspace is left to a new
+        REINDEX_WORKSPACE event, which is how progress is checkpointed.
+        """
+        wsinfo = self._get_ws_info(wsid)
+        params = {'ids': [wsid], 'minObjectID': start,
+                  'limit': self.reindex_page}
+        if objtype is not None:
+            params['type'] = objtype
+        objs = self.ws.list_objects(params)
+        events = self.ep.object_events(objs, wsinfo=wsinfo, index=index)
+        for i in range(0, len(events), self.reindex_batch):
+            batch = events[i:i + self.reindex_batch]
+            for (evt, err) in self.process_events(batch):
+                self.ep.retry_event(evt, err)
+        if len(objs) >= self.reindex_page:
+            self.ep.reindex_workspace(wsid, objs[-1][0] + 1,
+                                      objtype=objtype, index=index)
+        failed = self.ep.checkpoint()
+        if failed > 0:
+            raise IOError("%d events for workspace %s weren't delivered" %
+                          (failed, wsid))
+
+    def _event_ws_info(self, event):
+        """
+        Return the workspace flags carried by a reindex event, or look them
+        up.
+        """
+        if 'wsflags' in event:
+            return event['wsflags']
+        return self._get_ws_info(event['accgrp'])
 
-    def _create_obj_rec(self, upa):
+    def _latest_info(self, event, index):
+        """
+        Return the info of the object's latest version.  A reindex event
+        carries the info it was listed with, which was the latest then, so
+        it's used unless a newer version has been indexed into index since
+        (live events overtake reindex ones).
+        """
+        if 'info' in event and \
+                not self._newer_indexed(index, event['accgrp'],
+                                        event['objid'], event['info'][4]):
+            return event['info']
+        oid = '%d/%s' % (event['accgrp'], event['objid'])
+        return self.ws.get_object_info3({'objects': [{'ref': oid}]})['infos'][0]
+
+    def _newer_indexed(self, index, wsid, objid, vers):
+        """
+        Check whether a version of the object after vers is in the index,
+        or has been written to it in this batch.
+        """
+        if self._versions is not None and \
+                (index, wsid, objid) in self._versions:
+            return self._versions[(index, wsid, objid)] > int(vers)
+        prefix = "WS:%d/%s" % (wsid, objid)
+        q = {"query": {"bool": {"filter": [
+            {"term": {"prefix": prefix}},
+            {"range": {"version": {"gt": int(vers)}}}]}}}
+        res = self.es.count(index=index, doc_type='data', body=q,
+                            ignore=[400, 404])
+        return res.get('count', 0) > 0
+
+    def _create_obj_rec(self, upa, event=None):
         (wsid, objid, vers) = self._split_upa(upa)
+        # Provenance isn't in the info tuple so the object is still needed
         req = {'objects': [{'ref': upa}], 'no_data': 1}
         obj = self.ws.get_objects2(req)['data'][0]
         info = obj['info']
 
-        wsinfo = self._get_ws_info(wsid)
+        if event is not None:
+            wsinfo = self._event_ws_info(event)
+        else:
+            wsinfo = self._get_ws_info(wsid)
         # Don't index temporary narratives
         if wsinfo['temp']:
             return None
@@ -139,15 +497,9 @@ class IndexerUtils:
 
         return rec
 
-    def _log_error(self, event, index, err):
-        mes = {
-            'event': event,
-            'index': index,
-            'error': str(type(err))
-        }
-        with open('error.log', 'a') as f:
-            f.write(json.dumps(mes))
-            f.write('\n')
+    def _log_error(self, event, index, err, duration=None, exc_info=None):
+        error_sink().write(event, err, index=index, duration=duration,
+                           exc_info=exc_info)
 
     def _access_rec(self, wsid, objid, vers, public=False):
         rec = {
@@ -170,6 +522,16 @@ class IndexerUtils:
         # type": "access"
         return rec
 
+    def _event_id(self, event):
+        """
+        Return the event's elastic id, using the precomputed one if it has
+        it.
+        """
+        eid = event.get('eid')
+        if eid is None:
+            eid = self._get_id(event['upa'])
+        return eid
+
     def _get_id(self, upa):
         """
         Return the elastic id
@@ -214,31 +576,24 @@ class IndexerUtils:
         error if it has
         """
         eid = self._get_id(upa)
-        res = self.es.create(index=index, parent=eid, doc_type='data',
-                             id=eid, routing=eid, body=doc, refresh=True)
+        res = self._write('create', index, 'data', eid, doc, parent=eid,
+                          routing=eid)
         return res
 
-    def _get_ws_info(self, wsid):
+    def _get_ws_info(self, wsid, cached=True):
+        if cached and self._ws_cache is not None and wsid in self._ws_cache:
+            return self._ws_cache[wsid]
         info = self.ws.get_workspace_info({'id': wsid})
-        meta = info[8]
-        # Don't index temporary narratives
-        temp = False
-        if meta.get('is_temporary') == 'true':
-            temp = True
-
-        public = False
-        if info[6] != 'n':
-            public = True
-
-        # TODO
-        shared = False
-
-        return {'wsid': wsid, 'info': info, 'meta': meta,
-                'temp': temp, 'public': public, 'shared': shared}
+        wsinfo = {'wsid': wsid, 'info': info, 'meta': info[8]}
+        wsinfo.update(workspace_flags(info))
+        if self._ws_cache is not None:
+            self._ws_cache[wsid] = wsinfo
+        return wsinfo
 
     def publish(self, wsid):
         # Find each index
-        wsinfo = self._get_ws_info(wsid)
+        # The publish state is what changed, so don't trust a cached copy
+        wsinfo = self._get_ws_info(wsid, cached=False)
         public = wsinfo['public']
 
         if public:
@@ -270,28 +625,35 @@ class IndexerUtils:
                     "source": "ctx._source.public=%s" % publics
                 }
             }
+        self._send_writes()
         active_indexes = self._get_all_active_indexes()
         for index in active_indexes:
+            refresh = self._refresh_arg(index, by_query=True)
             res = self.es.update_by_query(index=index, doc_type='access',
                                           body=aq, ignore=[400, 404],
-                                          refresh=True)
+                                          refresh=refresh)
             res = self.es.update_by_query(index=index, doc_type='data',
                                           body=dq, ignore=[400, 404],
-                                          refresh=True)
+                                          refresh=refresh)
 
     def _get_all_active_indexes(self):
+        if self._ws_cache is not None and self._active_indexes is not None:
+            return self._active_indexes
         indexes = []
         for oindex in self.mapping:
             for index in self.mapping[oindex]:
                 indexes.append(index['index_name'])
         index_list = ','.join(indexes)
         active_indexes = self.es.indices.get(index_list, ignore_unavailable=True)
+        if self._ws_cache is not None:
+            self._active_indexes = active_indexes
 
         return active_indexes
 
     def delete(self, event):
         # Find each index
-        id = self._get_id(event['upa'])
+        id = self._event_id(event)
+        self._send_writes()
         active_indexes = self._get_all_active_indexes()
         q = {
             'query': {
@@ -304,20 +666,21 @@ class IndexerUtils:
         for index in active_indexes:
             res = self.es.delete_by_query(index=index, doc_type='data',
                                           routing=id, body=q, ignore=[400, 404],
-                                          refresh=True)
+                                          refresh=self._refresh_arg(index, by_query=True))
             self.es.delete(index=index, doc_type='access', id=id, ignore=404,
-                           refresh=True)
+                           refresh=self._refresh_arg(index))
 
-    def _update_es_access(self, index, wsid, objid, vers, upa):
+    def _update_es_access(self, index, wsid, objid, vers, upa, wsinfo=None):
         # Should pass a wsid but just in case...
-        wsinfo = self._get_ws_info(wsid)
+        if wsinfo is None:
+            wsinfo = self._get_ws_info(wsid)
         if wsinfo['temp']:
             return None
         public = wsinfo['public']
         doc = self._access_rec(wsid, objid, vers, public=public)
         eid = self._get_id(upa)
-        res = self.es.index(index=index, doc_type='access', id=eid, body=doc,
-                            refresh=True)
+        res = self._write('index', index, 'access', eid, doc)
+        self._mark_indexed(index, 'access', eid)
         return res
 
     def _split_upa(self, upa):
@@ -328,6 +691,18 @@ class IndexerUtils:
             return self.mapping[otype]
         return self.mapping['Other']
 
+    def _event_indexes(self, event):
+        """
+        Return the indexes for the event's object.  A targeted reindex event
+        names the one index (as in mapping.yaml) to update.
+        """
+        indexes = self._get_indexes(event['objtype'])
+        target = event.get('index')
+        if target is None:
+            return indexes
+        full = '%s.%s' % (self.esbase, target)
+        return [i for i in indexes if i['index_name'] in [target, full]]
+
     def _check_mapping(self, oindex, objschema):
         index = oindex['index_name']
         res = self.es.indices.exists(index=index)
@@ -343,9 +718,8 @@ class IndexerUtils:
     def _new_raw_version_index(self, event, oindex):
         upa = event['upa']
         index = oindex['index_name']
-        eid = self._get_id(upa)
-        res = self.es.get(index=index, doc_type='data', id=eid, ignore=404)
-        if res.get('status') != 404 and res['found']:
+        eid = self._event_id(event)
+        if self._is_indexed(index, 'data', eid):
             self.log.info("%s already indexed in %s" % (eid, index))
             return
 
@@ -358,8 +732,8 @@ class IndexerUtils:
             return
         self._check_mapping(oindex, resp['schema'])
         doc = resp['data']
-        res = self.es.create(index=index, doc_type='data',
-                             id=eid, body=doc, refresh=True)
+        self._write('create', index, 'data', eid, doc)
+        self._mark_indexed(index, 'data', eid)
 
     def _new_object_version_index(self, event, oindex):
         wsid = event['accgrp']
@@ -368,13 +742,15 @@ class IndexerUtils:
         upa = event['upa']
         index = oindex['index_name']
 
-        eid = self._get_id(upa)
-        res = self.es.get(index=index, doc_type='access', id=eid, ignore=404)
-        if res.get('status') != 404 and res['found']:
+        eid = self._event_id(event)
+        if self._is_indexed(index, 'access', eid):
             self.log.info("%s already indexed in %s" % (eid, index))
             return
 
-        doc = self._create_obj_rec(upa)
+        doc = self._create_obj_rec(upa, event)
+        if doc is None:
+            # Temporary narratives aren't indexed
+            return
         params = {'upa': upa}
         extra = {}
         schema = None
@@ -387,11 +763,14 @@ class IndexerUtils:
         if 'data' in extra and extra['data'] is not None:
             doc['keys'] = extra['data']
             doc['ojson'] = json.dumps(doc['keys'])
-        self._update_es_access(index, wsid, objid, vers, upa)
-        res = self._put_es_data_record(index, upa, doc)
-        oid = '%d/%s' % (wsid, objid)
-        info = self.ws.get_object_info3({'objects': [{'ref': oid}]})['infos'][0]
-        if info[4] == vers:
+        # Set islast up front; without a refresh the update below can't see
+        # the new document.  It still clears the older versions.
+        doc['islast'] = self._latest_info(event, index)[4] == vers
+        self._update_es_access(index, wsid, objid, vers, upa,
+                               wsinfo=self._event_ws_info(event))
+        self._put_es_data_record(index, upa, doc)
+        self._mark_version(index, wsid, objid, vers)
+        if doc['islast']:
             self._update_islast(index, wsid, objid, vers)
 
     def _new_object_version_multi_index(self, event, oindex):
@@ -407,13 +786,15 @@ class IndexerUtils:
         index = oindex['index_name']
 
         # Check if any exists
-        eid = self._get_id(upa)
-        res = self.es.get(index=index, doc_type='access', id=eid, ignore=404)
-        if res.get('status') != 404 and res['found']:
+        eid = self._event_id(event)
+        if self._is_indexed(index, 'access', eid):
             self.log.info("%s already indexed in %s" % (eid, index))
             return
 
-        doc = self._create_obj_rec(upa)
+        doc = self._create_obj_rec(upa, event)
+        if doc is None:
+            # Temporary narratives aren't indexed
+            return
         params = {'upa': upa}
         (module, method) = oindex['index_method'].split('.')
         extra = self.mr.run(module, method, params)[0]
@@ -424,7 +805,8 @@ class IndexerUtils:
             features = extra['features']
         recs = []
         doc['pjson'] = json.dumps(parent)
-        pguid = self._get_id(upa)
+        doc['islast'] = self._latest_info(event, index)[4] == vers
+        pguid = eid
         bdoc = []
         ct = 0
         for row in extra['features']:
@@ -435,7 +817,12 @@ class IndexerUtils:
             guid = guid.replace('/', ':')
             doc['guid'] = guid
             doc['ojson'] = json.dumps(doc['keys'])
-            rec = {'_id': guid, '_source': doc, '_index': index,
+            if self.bulk is not None:
+                self._write('index', index, 'data', guid, dict(doc),
+                            parent=pguid)
+                continue
+            # Each row needs its own copy of the record
+            rec = {'_id': guid, '_source': dict(doc), '_index': index,
                    '_parent': pguid, '_type': 'data'}
             bdoc.append(rec)
             ct += 1
@@ -447,18 +834,19 @@ class IndexerUtils:
         if ct > 0:
             bulk(self.es, bdoc)
 
-        self._update_es_access(index, wsid, objid, vers, upa)
-        oid = '%d/%s' % (wsid, objid)
-        info = self.ws.get_object_info3({'objects': [{'ref': oid}]})['infos'][0]
-        if info[4] == vers:
-            self._update_islast(index, wsid, objid, info[4])
+        self._update_es_access(index, wsid, objid, vers, upa,
+                               wsinfo=self._event_ws_info(event))
+        self._mark_version(index, wsid, objid, vers)
+        if doc['islast']:
+            self._update_islast(index, wsid, objid, vers)
 
     def _update_islast(self, index, wsid, objid, vers):
         prefix = "WS:%d/%s" % (wsid, objid)
         doc = {"query": {"bool": {"filter": [{"term": {"prefix": prefix}}]}},
                "script": {"source": "ctx._source.islast = (ctx._source.version == params.lastver)",
                           "params": {"lastver": int(vers)}}}
-        res = self.es.update_by_query(index, 'data', doc, refresh=True)
+        res = self.es.update_by_query(index, 'data', doc,
+                                      refresh=self._refresh_arg(index, by_query=True))
 
     def new_object_version(self, event):
         # For a NEW ALL VERSION we will just index the latest versions
@@ -471,8 +859,13 @@ class IndexerUtils:
             (event['objtype'], event['objtypever']) = info[2].split('-')
             event['upa'] = '%s/%s' % (upa, vers)
 
-        indexes = self._get_indexes(event['objtype'])
+        indexes = self._event_indexes(event)
+        if len(indexes) == 0:
+            self.log.warning("No index %s for %s" %
+                             (event.get('index'), event['objtype']))
+        ok = True
         for oindex in indexes:
+            start = time()
             try:
                 if 'multi' in oindex and oindex['multi']:
                     self._new_object_version_multi_index(event, oindex)
@@ -481,13 +874,10 @@ class IndexerUtils:
                 else:
                     self._new_object_version_index(event, oindex)
             except Exception as e:
-                self.log.error("Failed for index")
-                self._log_error(event, oindex, e)
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                self.log.info("*** print_tb:")
-                traceback.print_tb(exc_traceback, limit=1, file=sys.stdout)
-                self.log.info("*** print_exception:")
-                traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                          limit=2, file=sys.stdout)
+                ok = False
+                self.log.error("Failed for index %s: %s" %
+                               (oindex['index_name'], str(e)))
+                self._log_error(event, oindex, e, duration=time() - start,
+                                exc_info=sys.exc_info())
         self.log.info("Completed new object version")
-        return True
+        return ok
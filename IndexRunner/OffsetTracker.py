@@ -0,0 +1,124 @@
+#
+# Offset bookkeeping for concurrently processed Kafka messages.
+# Messages complete out of order once they are spread over workers, so a
+# partition's position may only move up to its oldest unfinished message.
+#
+from confluent_kafka import TopicPartition, KafkaException
+from threading import Lock
+from time import time
+import logging
+
+
+class OffsetTracker:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = dict()
+        self.next = dict()
+        self.reported = dict()
+        self.completed = 0
+
+    def add(self, topic, partition, offset):
+        """
+        Record that a message has been handed off for processing.
+        """
+        key = (topic, partition)
+        with self.lock:
+            self.pending.setdefault(key, set()).add(offset)
+            if offset + 1 > self.next.get(key, 0):
+                self.next[key] = offset + 1
+
+    def done(self, topic, partition, offset):
+        """
+        Record that a message has finished processing.
+        """
+        key = (topic, partition)
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].discard(offset)
+                self.completed += 1
+
+    def inflight(self):
+        """
+        Return the number of messages handed off but not yet done.
+        """
+        with self.lock:
+            return sum(len(p) for p in self.pending.values())
+
+    def committable(self, everything=False):
+        """
+        Return a list of (topic, partition, offset) positions that have moved
+        since the last call, or all of them if everything is set.  The offset
+        is the next message to consume, as Kafka expects.
+        """
+        moved = []
+        with self.lock:
+            for key, pend in self.pending.items():
+                if len(pend) > 0:
+                    pos = min(pend)
+                else:
+                    pos = self.next[key]
+                if everything or self.reported.get(key) != pos:
+                    self.reported[key] = pos
+                    moved.append((key[0], key[1], pos))
+        return moved
+
+    def forget(self, partitions):
+        """
+        Drop all state for the given (topic, partition) pairs.  Used when
+        partitions are revoked; anything still in flight for them will be
+        redelivered to the new owner.
+        """
+        with self.lock:
+            for key in partitions:
+                self.pending.pop(key, None)
+                self.next.pop(key, None)
+                self.reported.pop(key, None)
+
+
+class OffsetCommitter:
+    """
+    Commit the tracker's positions back to Kafka.  Commits are asynchronous
+    and batched: one is only sent once commit_count messages have completed
+    or commit_interval seconds have passed since the last one.
+    """
+
+    def __init__(self, consumer, tracker, commit_count=500,
+                 commit_interval=5.0):
+        self.log = logging.getLogger('indexrunner')
+        self.consumer = consumer
+        self.tracker = tracker
+        self.commit_count = commit_count
+        self.commit_interval = commit_interval
+        self.last_time = time()
+        self.last_completed = 0
+
+    def maybe_commit(self):
+        completed = self.tracker.completed - self.last_completed
+        if completed == 0:
+            return
+        if completed >= self.commit_count or \
+                time() - self.last_time >= self.commit_interval:
+            self.commit()
+
+    def commit(self, asynchronous=True):
+        self.last_time = time()
+        self.last_completed = self.tracker.completed
+        # A synchronous commit resends everything in case an earlier
+        # asynchronous one was lost.
+        positions = self.tracker.committable(everything=not asynchronous)
+        offsets = [TopicPartition(t, p, o) for (t, p, o) in positions]
+        if len(offsets) == 0:
+            return
+        try:
+            self.consumer.commit(offsets=offsets, asynchronous=asynchronous)
+        except KafkaException as e:
+            self.log.warning("Offset commit failed: " + str(e))
+
+    def on_revoke(self, consumer, partitions):
+        """
+        Rebalance callback.  Commit whatever has finished before giving the
+        partitions up.
+        """
+        self.commit(asynchronous=False)
+        self.tracker.forget([(p.topic, p.partition) for p in partitions])
@@ -0,0 +1,164 @@
+#
+# Rate limiting for generated index events
+# A reindex can list tens of thousands of objects in seconds and every one
+# of those events later starts an indexer container.  A token bucket caps
+# how fast they are produced, and the adaptive variant slows down further
+# while the index topic's consumer lag is high.  The limit is for the whole
+# process: every producer shares one bucket.
+#
+from confluent_kafka import Consumer, TopicPartition
+from IndexRunner.ConfigUtils import get_int, get_float
+from threading import Lock
+from time import time, sleep
+import logging
+
+# Limiters shared by the producers of this process, by their settings
+_limiters = dict()
+_limiters_lock = Lock()
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        """
+        rate is in events per second; burst is how many can go at once
+        (rate by default).
+        """
+        if burst is None:
+            burst = max(1, int(rate))
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time()
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, count=1):
+        """
+        Take count tokens if they are available and return 0, otherwise
+        return how long to wait before trying again.
+        """
+        with self.lock:
+            self._refill(time())
+            if self.tokens >= count:
+                self.tokens -= count
+                return 0
+            return (count - self.tokens) / self.rate
+
+    def acquire(self, count=1):
+        """
+        Block until count tokens are available.
+        """
+        while True:
+            delay = self.wait_time(count)
+            if delay <= 0:
+                return
+            sleep(delay)
+
+
+def consumer_lag(consumer, topic):
+    """
+    Return the total lag of the consumer's group on a topic.  Partitions
+    without a committed offset count from the start of the partition.
+    """
+    meta = consumer.list_topics(topic, timeout=10)
+    partitions = [TopicPartition(topic, p)
+                  for p in meta.topics[topic].partitions]
+    lag = 0
+    for tp in consumer.committed(partitions, timeout=10):
+        (low, high) = consumer.get_watermark_offsets(tp, timeout=10)
+        pos = tp.offset if tp.offset >= 0 else low
+        lag += max(0, high - pos)
+    return lag
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    A token bucket whose rate is scaled down by target_lag / lag whenever
+    the lag reported by lag_fn is above target_lag.  The lag is checked at
+    most every check_interval seconds.
+    """
+
+    def __init__(self, rate, lag_fn, target_lag, burst=None, min_rate=1.0,
+                 check_interval=10.0):
+        super().__init__(rate, burst)
+        self.log = logging.getLogger('indexrunner')
+        self.base_rate = self.rate
+        self.lag_fn = lag_fn
+        self.target_lag = target_lag
+        self.min_rate = min_rate
+        self.check_interval = check_interval
+        self.last_check = 0
+
+    def _adjust(self):
+        now = time()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        try:
+            lag = self.lag_fn()
+        except Exception as e:
+            self.log.warning("Couldn't read consumer lag: " + str(e))
+            return
+        rate = self.base_rate
+        if lag > self.target_lag:
+            rate = max(self.min_rate, rate * self.target_lag / lag)
+        if rate != self.rate:
+            self.log.info("Index event rate %.1f/s (lag %d)" % (rate, lag))
+            with self.lock:
+                self._refill(now)
+                self.rate = rate
+
+    def wait_time(self, count=1):
+        self._adjust()
+        return super().wait_time(count)
+
+
+def rate_limiter(config):
+    """
+    Build the limiter for generated index events from the config, or
+    return None if reindex-rate isn't set.
+    """
+    rate = get_float(config, 'reindex-rate', 0)
+    if rate <= 0:
+        return None
+    burst = get_int(config, 'reindex-burst', None)
+    target_lag = get_int(config, 'reindex-target-lag', 0)
+    if target_lag <= 0:
+        return TokenBucket(rate, burst)
+
+    topic = config.get('kafka-index-topic', 'idxevents')
+    consumers = []
+
+    def lag():
+        # Only used for metadata and offsets, so it never subscribes
+        if len(consumers) == 0:
+            consumers.append(Consumer({
+                'bootstrap.servers': config.get('kafka-server', 'kafka'),
+                'group.id': config.get('kafka-clientgroup', 'search_indexer'),
+                'enable.auto.commit': False
+            }))
+        return consumer_lag(consumers[0], topic)
+    return AdaptiveTokenBucket(rate, lag, target_lag, burst=burst,
+                               min_rate=get_float(config, 'reindex-min-rate',
+                                                  1.0))
+
+
+def shared_rate_limiter(config):
+    """
+    Return the process-wide limiter for the config, building it the first
+    time.  Producers with the same settings share it, so reindex-rate caps
+    the process as a whole rather than each producer.
+    """
+    key = tuple(config.get(k) for k in
+                ['reindex-rate', 'reindex-burst', 'reindex-target-lag',
+                 'reindex-min-rate', 'kafka-index-topic', 'kafka-server',
+                 'kafka-clientgroup'])
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = rate_limiter(config)
+        return _limiters[key]
@@ -0,0 +1,86 @@
+#
+# Elasticsearch refresh policy
+# Decide how each write is made visible to searches instead of forcing a
+# refresh on every one.  Policies can be set per index (a refresh key on
+# the index in the mapping file) and per kind of event (es-refresh-events),
+# with es-refresh as the default.  The kinds of event are the event types
+# plus REINDEX for events generated by a reindex.
+#
+#   true     - refresh as part of the write (the old behaviour)
+#   wait_for - wait for the next scheduled refresh
+#   none     - don't refresh; the index's refresh_interval takes care of it
+#   batch    - refresh each index written to once at the end of the batch
+#
+from IndexRunner.ConfigUtils import get_str
+
+POLICIES = ['true', 'wait_for', 'none', 'batch']
+
+
+def _check(policy):
+    policy = str(policy).lower()
+    if policy == 'false':
+        policy = 'none'
+    if policy not in POLICIES:
+        raise ValueError("Unknown refresh policy " + policy)
+    return policy
+
+
+def event_kind(event):
+    """
+    Events generated by a reindex carry the object info (see
+    EventProducer.object_events); everything else goes by its type.
+    """
+    if event is None:
+        return None
+    if 'info' in event:
+        return 'REINDEX'
+    return event['evtype']
+
+
+class RefreshPolicy:
+
+    def __init__(self, default='true', indexes=None, events=None):
+        self.default = _check(default)
+        self.indexes = {k: _check(v) for k, v in (indexes or {}).items()}
+        self.events = {k: _check(v) for k, v in (events or {}).items()}
+
+    @classmethod
+    def from_config(cls, config, mapping):
+        """
+        mapping is the indexer's mapping (object type to list of indexes).
+        """
+        indexes = dict()
+        for otype in mapping:
+            for oindex in mapping[otype]:
+                if 'refresh' in oindex:
+                    indexes[oindex['index_name']] = oindex['refresh']
+        events = dict()
+        spec = get_str(config, 'es-refresh-events')
+        if spec is not None:
+            for item in spec.split(','):
+                (kind, policy) = item.split(':')
+                events[kind.strip()] = policy.strip()
+        return cls(get_str(config, 'es-refresh', 'true'), indexes=indexes,
+                   events=events)
+
+    def policy(self, index, event=None):
+        """
+        The event's policy wins over the index's, which wins over the
+        default.
+        """
+        kind = event_kind(event)
+        if kind in self.events:
+            return self.events[kind]
+        return self.indexes.get(index, self.default)
+
+    @staticmethod
+    def refresh_arg(policy, by_query=False):
+        """
+        Return the refresh argument for an Elasticsearch call.  The by query
+        APIs only take true or false.
+        """
+        if policy == 'true':
+            return 'true'
+        if policy == 'wait_for':
+            return 'true' if by_query else 'wait_for'
+        return 'false'
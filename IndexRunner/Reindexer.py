@@ -0,0 +1,245 @@
+#
+# Full reindex
+# Generate index events for every workspace.  Workspaces are listed in
+# parallel and progress (finished workspaces and the next object id of the
+# ones in progress) is saved to a checkpoint file so an interrupted run
+# carries on where it stopped.
+#
+# python -m IndexRunner.Reindexer [--threads N] [--checkpoint file] [--restart]
+#                                 [--type KBaseGenomes.Genome [--index name]]
+#
+from IndexRunner.WSAdminUtils import WorkspaceAdminUtil, workspace_flags
+from IndexRunner.EventProducer import EventProducer
+from IndexRunner.ConfigUtils import get_int
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from threading import Lock, local
+from time import time
+import argparse
+import json
+import logging
+import os
+import sys
+
+
+class Checkpoint:
+    """
+    Reindex progress.  Workspaces are finished out of order, so the file
+    keeps the id up to which every workspace is done, the finished ones
+    past that, and the next object id for the ones part way through.
+    """
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.lock = Lock()
+        self.last_wsid = None
+        self.done = set()
+        self.partial = dict()
+        self.last_save = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.last_wsid = state.get('last_wsid')
+            self.done = set(state.get('done', []))
+            self.partial = {int(k): v for k, v in state['partial'].items()}
+
+    def start_for(self, wsid):
+        """
+        Return the object id to start the workspace from, or None if it's
+        already done.
+        """
+        with self.lock:
+            if wsid in self.done or \
+                    (self.last_wsid is not None and wsid <= self.last_wsid):
+                return None
+            return self.partial.get(wsid, 0)
+
+    def progress(self, wsid, next_objid):
+        with self.lock:
+            self.partial[wsid] = next_objid
+        self.save()
+
+    def finish(self, wsid):
+        with self.lock:
+            self.partial.pop(wsid, None)
+            self.done.add(wsid)
+        self.save()
+
+    def compact(self, wsids):
+        """
+        Fold the finished workspaces at the start of the (sorted) list of
+        workspace ids into last_wsid.
+        """
+        with self.lock:
+            for wsid in wsids:
+                if self.last_wsid is not None and wsid <= self.last_wsid:
+                    continue
+                if wsid not in self.done:
+                    break
+                self.last_wsid = wsid
+                self.done.discard(wsid)
+
+    def save(self, force=False):
+        if self.path is None:
+            return
+        with self.lock:
+            if not force and time() - self.last_save < self.interval:
+                return
+            self.last_save = time()
+            state = {'last_wsid': self.last_wsid,
+                     'done': sorted(self.done),
+                     'partial': self.partial}
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.path)
+
+
+class Reindexer:
+
+    def __init__(self, config, checkpoint, threads=None, objtype=None,
+                 index=None):
+        """
+        If objtype is set only objects of that type are reindexed, and if
+        index is set too (a name from mapping.yaml) only into that index.
+        """
+        self.log = logging.getLogger('indexrunner')
+        self.objtype = objtype
+        self.index = index
+        self.config = config
+        self.checkpoint = checkpoint
+        self.threads = threads or get_int(config, 'reindex-threads', 4)
+        self.page_size = get_int(config, 'reindex-page-size', 1000)
+        self.local = local()
+        self.lock = Lock()
+        self.producers = []
+        self.failed = []
+
+    def _ws(self):
+        # Each thread gets its own workspace client
+        if not hasattr(self.local, 'ws'):
+            self.local.ws = WorkspaceAdminUtil(self.config)
+        return self.local.ws
+
+    def _ep(self):
+        # And its own producer, so a checkpoint only waits for (and counts
+        # the failures of) the events of the workspace that thread is on
+        if not hasattr(self.local, 'ep'):
+            self.local.ep = EventProducer(self.config)
+            with self.lock:
+                self.producers.append(self.local.ep)
+        return self.local.ep
+
+    def workspace_ids(self):
+        """
+        Return the sorted ids of every workspace, including public ones.
+        """
+        res = self._ws().list_workspace_ids({'excludeGlobal': 0})
+        return sorted(set(res['workspaces']) | set(res.get('pub', [])))
+
+    def index_workspace(self, wsid):
+        start = self.checkpoint.start_for(wsid)
+        if start is None:
+            return
+        ws = self._ws()
+        ep = self._ep()
+        try:
+            wsinfo = workspace_flags(ws.get_workspace_info({'id': wsid}))
+            while True:
+                params = {'ids': [wsid], 'minObjectID': start,
+                          'limit': self.page_size}
+                if self.objtype is not None:
+                    params['type'] = self.objtype
+                objs = ws.list_objects(params)
+                ep.index_objects(objs, wsinfo=wsinfo, index=self.index)
+                # Only record progress once the events are delivered
+                failed = ep.checkpoint()
+                if failed > 0:
+                    raise IOError("%d events weren't delivered" % (failed))
+                if len(objs) < self.page_size:
+                    break
+                start = objs[-1][0] + 1
+                self.checkpoint.progress(wsid, start)
+            self.checkpoint.finish(wsid)
+        except Exception as e:
+            self.log.error("Reindex of workspace %d failed: %s" % (wsid, e))
+            self.failed.append(wsid)
+
+    def run(self, wsids=None):
+        """
+        Reindex the given workspaces, or all of them.  Returns the ids of
+        the ones that failed.
+        """
+        # The last_wsid watermark covers every workspace below it, so it
+        # can only be moved on by a run over all of them.
+        full = wsids is None
+        if full:
+            wsids = self.workspace_ids()
+        self.log.info("Reindexing %d workspaces with %d threads" %
+                      (len(wsids), self.threads))
+        if full:
+            self.checkpoint.compact(wsids)
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(self.index_workspace, wsids))
+        if full:
+            self.checkpoint.compact(wsids)
+        self.checkpoint.save(force=True)
+        for ep in self.producers:
+            ep.flush()
+        return self.failed
+
+
+def _read_config(config_file):
+    config = ConfigParser()
+    config.read(config_file)
+    cfg = dict()
+    for nameval in config.items('IndexRunner'):
+        cfg[nameval[0]] = nameval[1]
+    return cfg
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reindex every workspace')
+    parser.add_argument('--config',
+                        default=os.environ.get('KB_DEPLOYMENT_CONFIG'))
+    parser.add_argument('--checkpoint', default=None,
+                        help='Progress file (reindex[-type[-index]].checkpoint)')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore any saved progress')
+    parser.add_argument('--workspaces', default=None,
+                        help='Comma separated workspace ids')
+    parser.add_argument('--type', default=None,
+                        help='Only reindex objects of this type')
+    parser.add_argument('--index', default=None,
+                        help='Only update this index (needs --type)')
+    args = parser.parse_args(argv)
+    if args.index is not None and args.type is None:
+        parser.error('--index needs --type')
+    if args.checkpoint is None:
+        args.checkpoint = 'reindex.checkpoint'
+        if args.index is not None:
+            args.checkpoint = 'reindex-%s-%s.checkpoint' % (args.type,
+                                                            args.index)
+        elif args.type is not None:
+            args.checkpoint = 'reindex-%s.checkpoint' % (args.type)
+    logging.basicConfig(level=logging.INFO)
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    cfg = _read_config(args.config)
+    wsids = None
+    if args.workspaces is not None:
+        wsids = sorted(int(w) for w in args.workspaces.split(','))
+    reindexer = Reindexer(cfg, Checkpoint(args.checkpoint),
+                          threads=args.threads, objtype=args.type,
+                          index=args.index)
+    failed = reindexer.run(wsids)
+    if len(failed) > 0:
+        print("Failed workspaces: %s" % (','.join(str(w) for w in failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#
+# Offline replay of recorded Kafka traffic
+# Feeds a JSON lines dump of wsevents/idxevents messages (one event per
+# line, as EventProducer.index_objects emits them) through IndexerUtils as
+# fast as possible and reports throughput, per event type latency
+# percentiles and failures.
+#
+# python -m IndexRunner.Replay [--batch-size N] [--limit N] dump.jsonl
+#
+from IndexRunner.IndexerUtils import IndexerUtils
+from IndexRunner.Event import Event
+from configparser import ConfigParser
+from time import time
+import argparse
+import json
+import os
+import sys
+
+
+def read_events(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            yield Event.decode(line)
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of an already sorted list.
+    """
+    if len(values) == 0:
+        return None
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class ReplayStats:
+
+    def __init__(self):
+        self.latencies = dict()
+        self.failures = dict()
+        self.count = 0
+        self.start = time()
+        self.end = None
+
+    def record(self, evtype, seconds, ok):
+        self.count += 1
+        self.latencies.setdefault(evtype, []).append(seconds)
+        if not ok:
+            self.failures[evtype] = self.failures.get(evtype, 0) + 1
+
+    def finish(self):
+        self.end = time()
+
+    def report(self):
+        elapsed = (self.end or time()) - self.start
+        rep = {
+            'events': self.count,
+            'seconds': elapsed,
+            'events_per_sec': self.count / elapsed if elapsed > 0 else None,
+            'failures': sum(self.failures.values()),
+            'types': dict()
+        }
+        for evtype, lat in self.latencies.items():
+            lat = sorted(lat)
+            rep['types'][evtype] = {
+                'count': len(lat),
+                'failures': self.failures.get(evtype, 0),
+                'p50': percentile(lat, 50),
+                'p90': percentile(lat, 90),
+                'p99': percentile(lat, 99),
+                'max': lat[-1]
+            }
+        return rep
+
+    def format(self):
+        rep = self.report()
+        lines = ['%d events in %.2fs (%.1f events/sec), %d failures' %
+                 (rep['events'], rep['seconds'], rep['events_per_sec'] or 0,
+                  rep['failures'])]
+        lines.append('%-24s %8s %8s %10s %10s %10s %10s' %
+                     ('evtype', 'count', 'failed', 'p50', 'p90', 'p99', 'max'))
+        for evtype in sorted(rep['types']):
+            t = rep['types'][evtype]
+            lines.append('%-24s %8d %8d %10.4f %10.4f %10.4f %10.4f' %
+                         (evtype, t['count'], t['failures'], t['p50'],
+                          t['p90'], t['p99'], t['max']))
+        return '\n'.join(lines)
+
+
+def replay(indexer, events, batch_size=1, limit=None):
+    """
+    Run events through the indexer and return a ReplayStats.  With a batch
+    size above one, events go through process_events and each event is
+    charged an equal share of its batch's time.
+    """
+    stats = ReplayStats()
+    batch = []
+
+    def run_batch():
+        start = time()
+        if len(batch) == 1:
+            failed = []
+            try:
+                if indexer.process_event(batch[0]) is False:
+                    failed = [batch[0]]
+            except Exception:
+                failed = [batch[0]]
+        else:
+            failed = [f[0] for f in indexer.process_events(batch)]
+        share = (time() - start) / len(batch)
+        for evt in batch:
+            stats.record(evt['evtype'], share,
+                         not any(evt is f for f in failed))
+
+    for i, evt in enumerate(events):
+        if limit is not None and i >= limit:
+            break
+        batch.append(evt)
+        if len(batch) >= batch_size:
+            run_batch()
+            batch = []
+    if len(batch) > 0:
+        run_batch()
+    stats.finish()
+    return stats
+
+
+def _read_config(config_file):
+    config = ConfigParser()
+    config.read(config_file)
+    cfg = dict()
+    for nameval in config.items('IndexRunner'):
+        cfg[nameval[0]] = nameval[1]
+    return cfg
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded events')
+    parser.add_argument('dump', help='JSON lines file of events')
+    parser.add_argument('--config',
+                        default=os.environ.get('KB_DEPLOYMENT_CONFIG'))
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args(argv)
+    indexer = IndexerUtils(_read_config(args.config))
+    stats = replay(indexer, read_events(args.dump),
+                   batch_size=args.batch_size, limit=args.limit)
+    if args.json:
+        print(json.dumps(stats.report()))
+    else:
+        print(stats.format())
+    return 0 if len(stats.failures) == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#
+# Multi-process supervisor
+# Runs several copies of the watcher as separate processes in the same
+# Kafka consumer group so the CPU heavy parts of indexing use more than one
+# core.  Workers that die are restarted and all of them are shut down
+# cleanly on SIGTERM/SIGINT.
+#
+from multiprocessing import Process
+import logging
+import os
+import signal
+import time
+
+
+def _run_worker(target, config):
+    # Turn SIGTERM into SystemExit so the watcher can commit and close
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(config)
+
+
+class Supervisor:
+
+    def __init__(self, target, config, workers, shutdown_timeout=60):
+        self.log = logging.getLogger('indexrunner')
+        self.target = target
+        self.config = config
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.procs = [None] * workers
+        self.stopping = False
+
+    def _spawn(self, slot):
+        p = Process(target=_run_worker, args=[self.target, self.config],
+                    name='indexrunner-%d' % (slot))
+        p.start()
+        self.log.info("Started worker %d (pid %s)" % (slot, p.pid))
+        self.procs[slot] = p
+
+    def start(self):
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+    def check(self):
+        """
+        Restart any worker that has exited.
+        """
+        for slot, p in enumerate(self.procs):
+            if p is not None and not p.is_alive():
+                self.log.error("Worker %d (pid %s) exited with %s, restarting" %
+                               (slot, p.pid, p.exitcode))
+                self._spawn(slot)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def shutdown(self):
+        """
+        Ask every worker to stop, wait for them and kill any stragglers.
+        """
+        for p in self.procs:
+            if p is not None and p.is_alive():
+                p.terminate()
+        deadline = time.time() + self.shutdown_timeout
+        for p in self.procs:
+            if p is None:
+                continue
+            p.join(max(0, deadline - time.time()))
+            if p.is_alive():
+                self.log.warning("Killing worker pid %s" % (p.pid))
+                os.kill(p.pid, signal.SIGKILL)
+                p.join()
+
+    def run(self, interval=5):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start()
+        while not self.stopping:
+            time.sleep(interval)
+            if not self.stopping:
+                self.check()
+        self.log.info("Shutting down workers")
+        self.shutdown()
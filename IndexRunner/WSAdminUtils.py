@@ -1,7 +1,12 @@
 from kbase.Workspace.WorkspaceClient import Workspace
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 # We have to use the administer method for all accesses
 
+# The most list_objects returns in one call
+_MAX_LIST = 10000
+
 
 class WorkspaceAdminUtil:
 
@@ -45,3 +50,95 @@ class WorkspaceAdminUtil:
         if self.noadmin:
             return self.ws.get_workspace_info(params)
         return self.ws.administer({'command': 'getWorkspaceInfo', 'params': params})
+
+    def list_workspace_ids(self, params):
+        """
+        Provide something that acts like a standard listWorkspaceIDs
+        """
+        if self.noadmin:
+            return self.ws.list_workspace_ids(params)
+        return self.ws.administer({'command': 'listWorkspaceIDs', 'params': params})
+
+    def _list_range(self, wsid, params, low, high, limit):
+        """
+        List the objects with ids from low to high (or on up if high is
+        None), a page of limit at a time.
+        """
+        objs = []
+        while True:
+            p = dict(params)
+            p.update({'ids': [wsid], 'minObjectID': low, 'limit': limit})
+            if high is not None:
+                p['maxObjectID'] = high
+            page = self.list_objects(p)
+            objs.extend(page)
+            if len(page) < limit:
+                return objs
+            low = page[-1][0] + 1
+            # A full chunk; don't ask for the ids past its end
+            if high is not None and low > high:
+                return objs
+
+    def iter_pages(self, wsid, params=None, start=0, max_objid=None,
+                   chunk_size=_MAX_LIST, threads=4):
+        """
+        Yield the workspace's objects as lists, in object id order.  The id
+        range up to max_objid (looked up if not given) is split into chunks
+        of chunk_size ids and up to threads chunks are listed at once, so
+        the next ones are fetched while the caller works on this one.
+        """
+        if params is None:
+            params = dict()
+        if max_objid is None:
+            max_objid = self.get_workspace_info({'id': wsid})[4]
+        chunk_size = min(chunk_size, _MAX_LIST)
+        ranges = []
+        low = start
+        while low <= max_objid:
+            ranges.append((low, low + chunk_size - 1))
+            low += chunk_size
+        # Anything saved since max_objid was read
+        ranges.append((low, None))
+
+        pool = ThreadPoolExecutor(max_workers=threads)
+        pending = deque()
+        try:
+            for (low, high) in ranges:
+                if len(pending) >= threads:
+                    page = pending.popleft().result()
+                    if len(page) > 0:
+                        yield page
+                pending.append(pool.submit(self._list_range, wsid, params,
+                                           low, high, chunk_size))
+            while len(pending) > 0:
+                page = pending.popleft().result()
+                if len(page) > 0:
+                    yield page
+        finally:
+            for f in pending:
+                f.cancel()
+            pool.shutdown(wait=False)
+
+    def iter_objects(self, wsid, params=None, start=0, max_objid=None,
+                     chunk_size=_MAX_LIST, threads=4):
+        """
+        Like iter_pages, but yield one object info at a time.
+        """
+        for page in self.iter_pages(wsid, params, start=start,
+                                    max_objid=max_objid,
+                                    chunk_size=chunk_size, threads=threads):
+            for obj in page:
+                yield obj
+
+
+def workspace_flags(info):
+    """
+    Return the temp/public/shared flags the indexer needs from a
+    workspace info tuple.
+    """
+    # Don't index temporary narratives
+    temp = info[8].get('is_temporary') == 'true'
+    public = info[6] != 'n'
+    # TODO
+    shared = False
+    return {'temp': temp, 'public': public, 'shared': shared}
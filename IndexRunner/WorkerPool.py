@@ -0,0 +1,113 @@
+#
+# Keyed worker pool
+# Items that share a key always go to the same worker thread and so are
+# processed in the order they were submitted.  Unrelated keys run in
+# parallel.
+#
+from queue import Queue, Empty
+from threading import Thread, Lock
+from zlib import crc32
+import logging
+
+
+class WorkerPool:
+
+    def __init__(self, handlers, callback=None):
+        """
+        Start one worker thread per handler.  Each handler is called with
+        the submitted item and callback (if given) is called afterwards,
+        whether or not the handler raised.
+        """
+        self.log = logging.getLogger('indexrunner')
+        self.callback = callback
+        # Items submitted and not yet finished
+        self.lock = Lock()
+        self.npending = 0
+        self.queues = []
+        self.threads = []
+        for handler in handlers:
+            q = Queue()
+            t = Thread(target=self._work, args=[handler, q])
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+            self.threads.append(t)
+
+    def size(self):
+        return len(self.queues)
+
+    def worker_for(self, key):
+        return crc32(key.encode('utf-8')) % len(self.queues)
+
+    def pending(self):
+        """
+        Return the number of submitted items that are queued or running.
+        """
+        with self.lock:
+            return self.npending
+
+    def _count(self, n):
+        with self.lock:
+            self.npending += n
+
+    def submit(self, key, item):
+        self._count(1)
+        self.queues[self.worker_for(key)].put(item)
+
+    def submit_many(self, items):
+        """
+        Submit a list of (key, item) pairs.  The items bound for each worker
+        are handed over together as a single list, in submission order.
+        """
+        groups = dict()
+        for (key, item) in items:
+            groups.setdefault(self.worker_for(key), []).append(item)
+        for (idx, group) in groups.items():
+            self._count(1)
+            self.queues[idx].put(group)
+
+    def _work(self, handler, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                break
+            try:
+                handler(item)
+            except BaseException as e:
+                self.log.error('Uncaught exception in worker: ' + str(e))
+            finally:
+                if self.callback is not None:
+                    self.callback(item)
+                self._count(-1)
+                q.task_done()
+
+    def join(self):
+        """
+        Wait until everything submitted so far has been processed.
+        """
+        for q in self.queues:
+            q.join()
+
+    def shutdown(self, discard=False):
+        """
+        Finish the queued work, including anything the callback submits,
+        and stop the worker threads.  If discard is set, work that hasn't
+        started yet is dropped without calling the callback.
+        """
+        while not discard and self.pending() > 0:
+            self.join()
+        if discard:
+            for q in self.queues:
+                while True:
+                    try:
+                        item = q.get_nowait()
+                    except Empty:
+                        break
+                    if item is not None:
+                        self._count(-1)
+                    q.task_done()
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,78 @@
+#
+# Workspace barriers
+# Object events for different objects run in parallel, but an event for a
+# whole workspace (publish, delete, copy, reindex) must not overlap its
+# object events: it waits for the ones in flight, and the ones after it
+# wait for it to finish.
+#
+from collections import deque
+from threading import Lock
+
+
+def is_workspace_event(data):
+    return 'ACCESS_GROUP' in data['evtype'] or \
+        data['evtype'] == 'REINDEX_WORKSPACE'
+
+
+class WorkspaceGate:
+
+    def __init__(self, event=lambda item: item):
+        """
+        event returns the event of an item (whatever is passed to admit).
+        """
+        self.event = event
+        self.lock = Lock()
+        self.running = dict()
+        self.barrier = set()
+        self.waiting = dict()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(w) for w in self.waiting.values())
+
+    def admit(self, items):
+        """
+        Return the items that can start now.  The rest are held until
+        done() lets them through, in order for each workspace.
+        """
+        ready = []
+        with self.lock:
+            for item in items:
+                wsid = self.event(item)['accgrp']
+                self.waiting.setdefault(wsid, deque()).append(item)
+                ready.extend(self._release(wsid))
+        return ready
+
+    def done(self, items):
+        """
+        Record that items have finished and return the ones that can start
+        because of it.
+        """
+        ready = []
+        with self.lock:
+            for item in items:
+                data = self.event(item)
+                wsid = data['accgrp']
+                if is_workspace_event(data):
+                    self.barrier.discard(wsid)
+                else:
+                    self.running[wsid] -= 1
+                    if self.running[wsid] == 0:
+                        del self.running[wsid]
+                ready.extend(self._release(wsid))
+        return ready
+
+    def _release(self, wsid):
+        waiting = self.waiting.get(wsid)
+        ready = []
+        while waiting and wsid not in self.barrier:
+            if is_workspace_event(self.event(waiting[0])):
+                if wsid in self.running:
+                    break
+                self.barrier.add(wsid)
+            else:
+                self.running[wsid] = self.running.get(wsid, 0) + 1
+            ready.append(waiting.popleft())
+        if waiting is not None and len(waiting) == 0:
+            del self.waiting[wsid]
+        return ready
@@ -1,5 +1,8 @@
 import os
 from IndexRunner.EventUtils import kafka_watcher
+from IndexRunner.AsyncEngine import async_watcher
+from IndexRunner.Supervisor import Supervisor
+from IndexRunner.ConfigUtils import get_int
 from configparser import ConfigParser
 import time
 import logging
@@ -29,8 +32,17 @@ cfg = dict()
 for nameval in config.items('IndexRunner'):
     cfg[nameval[0]] = nameval[1]
 
-kafka_thread = Thread(target=kafka_watcher, args=[cfg])
-kafka_thread.daemon = True
-kafka_thread.start()
-while True:
-    time.sleep(600)
+watcher = kafka_watcher
+if cfg.get('engine') == 'asyncio':
+    watcher = async_watcher
+
+workers = get_int(cfg, 'workers', 1)
+if workers > 1:
+    # Each worker process joins the same consumer group
+    Supervisor(watcher, cfg, workers).run()
+else:
+    kafka_thread = Thread(target=watcher, args=[cfg])
+    kafka_thread.daemon = True
+    kafka_thread.start()
+    while True:
+        time.sleep(600)
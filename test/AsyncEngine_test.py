@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch, Mock
+import json
+import time
+from threading import Lock
+from IndexRunner.AsyncEngine import async_watcher
+from EventHandler_test import mymessage
+
+
+class AsyncEngineTest(unittest.TestCase):
+
+    def _ev(self, objid, ver):
+        ev = {
+            'strcde': 'WS',
+            'accgrp': 1,
+            'objid': objid,
+            'ver': ver,
+            'newname': None,
+            'evtype': 'NEW_VERSION',
+            'time': '2018-02-08T23:23:25.553Z',
+            'objtype': 'KBaseNarrative.Narrative',
+            'objtypever': 4,
+            'public': False
+            }
+        return json.dumps(ev).encode()
+
+    @patch('IndexRunner.AsyncEngine.Consumer', autospec=True)
+    @patch('IndexRunner.AsyncEngine.IndexerUtils', autospec=True)
+    def test_engine(self, mock_in, mock_con):
+        (mock_in.return_value.es, mock_in.return_value.ep) = (Mock(), Mock())
+        lock = Lock()
+        seen = []
+
+        def process(ev):
+            # Earlier versions are slower, but must still finish first
+            time.sleep(0.1 / ev['ver'])
+            with lock:
+                seen.append((ev['objid'], ev['ver']))
+
+        mock_in.return_value.process_event.side_effect = process
+        msgs = [mymessage(self._ev('2', v), offset=v) for v in [1, 2, 3]]
+        msgs.append(mymessage(self._ev('3', 1), offset=4))
+        mock_con.return_value.consume.return_value = msgs
+        async_watcher({'run_one': 1, 'async-concurrency': '4'})
+        self.assertEqual(mock_in.call_count, 4)
+        versions = [v for (o, v) in seen if o == '2']
+        self.assertEqual(versions, [1, 2, 3])
+        self.assertEqual(len(seen), 4)
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 5)
+        self.assertFalse(commit['asynchronous'])
+
+    @patch('IndexRunner.AsyncEngine.Consumer', autospec=True)
+    @patch('IndexRunner.AsyncEngine.IndexerUtils', autospec=True)
+    def test_engine_workspace(self, mock_in, mock_con):
+        (mock_in.return_value.es, mock_in.return_value.ep) = (Mock(), Mock())
+        lock = Lock()
+        times = dict()
+
+        def process(ev):
+            start = time.time()
+            time.sleep(0.2)
+            with lock:
+                times[ev['objid']] = (start, time.time())
+
+        mock_in.return_value.process_event.side_effect = process
+        pub = json.loads(self._ev(None, None).decode())
+        pub['evtype'] = 'PUBLISH_ACCESS_GROUP'
+        msgs = [mymessage(self._ev('2', 1), offset=0),
+                mymessage(self._ev('3', 1), offset=1),
+                mymessage(json.dumps(pub).encode(), offset=2),
+                mymessage(self._ev('4', 1), offset=3)]
+        mock_con.return_value.consume.return_value = msgs
+        async_watcher({'run_one': 1, 'async-concurrency': '4'})
+        # Objects of a workspace run in parallel
+        self.assertLess(times['3'][0], times['2'][1])
+        # The publish waits for them, and the next object for the publish
+        self.assertGreaterEqual(times[None][0],
+                                max(times['2'][1], times['3'][1]))
+        self.assertGreaterEqual(times['4'][0], times[None][1])
+
+    @patch('IndexRunner.AsyncEngine.Consumer', autospec=True)
+    @patch('IndexRunner.AsyncEngine.IndexerUtils', autospec=True)
+    def test_engine_retry(self, mock_in, mock_con):
+        ep = mock_in.return_value.ep = Mock()
+        mock_in.return_value.es = Mock()
+        mock_in.return_value.process_event.return_value = False
+        mock_con.return_value.consume.return_value = [
+            mymessage(self._ev('2', 1))]
+        async_watcher({'run_one': 1, 'async-concurrency': '2',
+                       'kafka-retry-topic': 'retries'})
+        ep.retry_events.assert_called_once()
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 1)
+
+        # The offset isn't moved on if the retry wasn't delivered
+        mock_con.return_value.commit.reset_mock()
+        ep.retry_events.return_value = False
+        async_watcher({'run_one': 1, 'async-concurrency': '2',
+                       'kafka-retry-topic': 'retries'})
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 0)
+
+    @patch('IndexRunner.AsyncEngine.Consumer', autospec=True)
+    @patch('IndexRunner.AsyncEngine.IndexerUtils', autospec=True)
+    def test_engine_interrupted(self, mock_in, mock_con):
+        ep = mock_in.return_value.ep = Mock()
+        mock_in.return_value.es = Mock()
+        batches = [[mymessage(self._ev('2', 1))]]
+
+        def consume(*args):
+            if len(batches) > 0:
+                return batches.pop()
+            # Give the first event time to finish, then get a SIGTERM
+            time.sleep(0.2)
+            raise SystemExit(1)
+        mock_con.return_value.consume.side_effect = consume
+        with self.assertRaises(SystemExit):
+            async_watcher({'async-concurrency': '2',
+                           'kafka-retry-topic': 'retries'})
+        # Completed offsets are still committed before closing
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 1)
+        self.assertFalse(commit['asynchronous'])
+        ep.flush.assert_called_once()
+        mock_con.return_value.close.assert_called_once()
+
+    @patch('IndexRunner.AsyncEngine.Consumer', autospec=True)
+    @patch('IndexRunner.AsyncEngine.IndexerUtils', autospec=True)
+    def test_engine_shared(self, mock_in, mock_con):
+        first = mock_in.return_value
+        (first.es, first.ep) = (Mock(), Mock())
+        mock_con.return_value.consume.return_value = []
+        async_watcher({'run_one': 1, 'async-concurrency': '3'})
+        # One producer and Elasticsearch client for all the indexers
+        self.assertEqual(mock_in.call_count, 3)
+        for c in mock_in.call_args_list[1:]:
+            self.assertIs(c[1]['es'], first.es)
+            self.assertIs(c[1]['ep'], first.ep)
+        # with a connection for each executor thread
+        self.assertEqual(mock_in.call_args_list[0][0][0]['es-maxsize'], '3')
+
+    @patch('IndexRunner.AsyncEngine.Consumer', autospec=True)
+    @patch('IndexRunner.AsyncEngine.IndexerUtils', autospec=True)
+    def test_engine_held(self, mock_in, mock_con):
+        (mock_in.return_value.es, mock_in.return_value.ep) = (Mock(), Mock())
+        ev = json.loads(self._ev('2', 1).decode())
+        ev['retry_at'] = time.time() + 600
+        mock_con.return_value.consume.return_value = [
+            mymessage(json.dumps(ev).encode(), topic='retries')]
+        # A retry that isn't due is held (and run here since run_one
+        # drains everything)
+        async_watcher({'run_one': 1, 'async-concurrency': '2'})
+        mock_in.return_value.process_event.assert_called_once()
+
+    def test_engine_lanes(self):
+        with self.assertRaises(ValueError):
+            async_watcher({'run_one': 1, 'kafka-lanes': 'weighted'})
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch, Mock
+from IndexRunner.BulkBuffer import BulkBuffer
+
+
+def _results(es, actions, **kw):
+    # Anything with a bad id fails
+    for a in actions:
+        if a['_id'] == 'bad':
+            yield (False, {a['_op_type']: {'_id': 'bad', 'status': 409}})
+        else:
+            yield (True, {a['_op_type']: {'_id': a['_id'], 'status': 201}})
+
+
+def _action(eid, op='create'):
+    return {'_op_type': op, '_index': 'ci.objects', '_type': 'data',
+            '_id': eid, '_source': {'guid': eid}}
+
+
+@patch('IndexRunner.BulkBuffer.streaming_bulk', side_effect=_results)
+class BulkBufferTest(unittest.TestCase):
+
+    def test_flush(self, mock_bulk):
+        buf = BulkBuffer(Mock(), max_actions=10, max_latency=60)
+        buf.add(_action('a'), owner='ev1')
+        buf.add(_action('bad'), owner='ev2', refresh='wait_for')
+        buf.add(_action('c', op='index'), owner='ev2')
+        mock_bulk.assert_not_called()
+        self.assertEqual(len(buf), 3)
+        errors = buf.flush()
+        mock_bulk.assert_called_once()
+        self.assertEqual(mock_bulk.call_args[1]['refresh'], 'wait_for')
+        self.assertEqual(len(buf), 0)
+        self.assertEqual([e[0] for e in errors], ['ev2'])
+        # Nothing left to send or report
+        self.assertEqual(buf.flush(), [])
+        mock_bulk.assert_called_once()
+
+    def test_count(self, mock_bulk):
+        buf = BulkBuffer(Mock(), max_actions=2, max_latency=60)
+        buf.add(_action('a'), owner='ev1')
+        mock_bulk.assert_not_called()
+        buf.add(_action('bad'), owner='ev1')
+        mock_bulk.assert_called_once()
+        self.assertEqual(len(buf), 0)
+        # Failures are kept for the next flush
+        self.assertEqual(buf.flush(), [('ev1', {'create': {
+            '_id': 'bad', 'status': 409}})])
+
+    def test_bytes(self, mock_bulk):
+        buf = BulkBuffer(Mock(), max_actions=100, max_bytes=50,
+                         max_latency=60)
+        buf.add(_action('a'))
+        mock_bulk.assert_not_called()
+        buf.add(_action('b' * 50))
+        mock_bulk.assert_called_once()
+
+    @patch('IndexRunner.BulkBuffer.time')
+    def test_latency(self, mock_time, mock_bulk):
+        mock_time.return_value = 100
+        buf = BulkBuffer(Mock(), max_actions=100, max_latency=1.0)
+        buf.add(_action('a'))
+        buf.maybe_flush()
+        mock_bulk.assert_not_called()
+        mock_time.return_value = 101.5
+        buf.maybe_flush()
+        mock_bulk.assert_called_once()
+
+    def test_from_config(self, mock_bulk):
+        cfg = {'es-bulk-actions': '20', 'es-bulk-latency': '0.5'}
+        buf = BulkBuffer.from_config(Mock(), cfg)
+        self.assertEqual(buf.max_actions, 20)
+        self.assertEqual(buf.max_bytes, 5242880)
+        self.assertEqual(buf.max_latency, 0.5)
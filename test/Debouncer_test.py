@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+from IndexRunner.Debouncer import Debouncer
+
+
+class DebouncerTest(unittest.TestCase):
+
+    def _ev(self, ver, objtype='KBaseNarrative.Narrative'):
+        return {'evtype': 'NEW_VERSION', 'accgrp': 1, 'objid': '2',
+                'ver': ver, 'objtype': objtype}
+
+    def test_quiet_period(self):
+        db = Debouncer({'KBaseNarrative.Narrative': 30}, max_wait=100)
+        self.assertFalse(db.wants(self._ev(1, objtype='KBaseGenomes.Genome')))
+        self.assertTrue(db.wants(self._ev(1)))
+        self.assertIsNone(db.offer('1/2', 'a', self._ev(1), now=0))
+        self.assertEqual(db.offer('1/2', 'b', self._ev(2), now=20), 'a')
+        # The second save restarted the clock
+        self.assertEqual(db.ready(now=40), [])
+        self.assertEqual(db.ready(now=50), [('1/2', 'b')])
+        self.assertEqual(len(db), 0)
+
+    def test_max_wait(self):
+        db = Debouncer({'KBaseNarrative.Narrative': 30}, max_wait=100)
+        for t in range(0, 100, 10):
+            db.offer('1/2', t, self._ev(t), now=t)
+        self.assertEqual(db.ready(now=100), [('1/2', 90)])
+
+    def test_release(self):
+        db = Debouncer({'KBaseNarrative.Narrative': 30})
+        db.offer('1/2', 'a', self._ev(1), now=0)
+        db.offer('1/3', 'b', self._ev(1), now=0)
+        self.assertEqual(db.release('1/2'), 'a')
+        self.assertIsNone(db.release('1/2'))
+        self.assertEqual(db.drain(), [('1/3', 'b')])
+
+    def test_mapfile(self):
+        mapfile = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'mapping.yaml')
+        db = Debouncer.from_mapfile(mapfile)
+        self.assertIn('KBaseNarrative.Narrative', db.periods)
+
+    def test_hold(self):
+        db = Debouncer(dict())
+        db.hold('retry:a', 'a', 50)
+        db.hold('retry:b', 'b', 10)
+        self.assertEqual(db.ready(now=20), [('retry:b', 'b')])
+        self.assertEqual(db.ready(now=50), [('retry:a', 'a')])
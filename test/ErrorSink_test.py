@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from IndexRunner.ErrorSink import ErrorSink
+
+
+class ErrorSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'error.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _read(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_buffered(self):
+        sink = ErrorSink(path=self.path, flush_interval=60)
+        sink.write({'accgrp': 1}, ValueError('bogus'),
+                   index={'index_name': 'genome',
+                          'index_method': 'kb_GenomeIndexer.genome_index'},
+                   duration=0.5)
+        sink.write('', 'bad kafka')
+        # Nothing is written until a flush
+        self.assertFalse(os.path.exists(self.path))
+        sink.flush()
+        recs = self._read()
+        self.assertEqual(len(recs), 2)
+        self.assertEqual(recs[0]['index'], 'genome')
+        self.assertEqual(recs[0]['module'], 'kb_GenomeIndexer')
+        self.assertEqual(recs[0]['error'], 'bogus')
+        self.assertEqual(recs[0]['error_type'], 'ValueError')
+        self.assertEqual(recs[0]['duration'], 0.5)
+        self.assertEqual(recs[1]['error'], 'bad kafka')
+
+    def test_background_flush(self):
+        sink = ErrorSink(path=self.path, flush_interval=0.1)
+        sink.write({}, 'bogus')
+        sink.thread.join(0.5)
+        self.assertEqual(len(self._read()), 1)
+
+    def test_rotate(self):
+        sink = ErrorSink(path=self.path, max_bytes=100, backups=2,
+                         flush_interval=60)
+        for i in range(3):
+            sink.write({'i': i}, 'x' * 100)
+            sink.flush()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self._read(self.path + '.1')[0]['event']['i'], 2)
+        self.assertEqual(self._read(self.path + '.2')[0]['event']['i'], 1)
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_traceback_rate(self):
+        sink = ErrorSink(path=self.path, traceback_rate=2, flush_interval=60)
+        for i in range(4):
+            try:
+                raise KeyError('bogus')
+            except KeyError as e:
+                sink.write({}, e, exc_info=sys.exc_info())
+        sink.flush()
+        recs = self._read()
+        self.assertEqual(len([r for r in recs if 'traceback' in r]), 2)
+        self.assertIn('KeyError', recs[0]['traceback'])
+        self.assertEqual(sink.suppressed, 2)
+
+    def test_write_failure(self):
+        # A log file that can't be written doesn't stop the flush thread
+        path = os.path.join(self.dir, 'missing', 'error.log')
+        sink = ErrorSink(path=path, flush_interval=0.05, max_buffer=2)
+        for i in range(3):
+            sink.write({'i': i}, 'bogus')
+        self.assertEqual(sink.dropped, 1)
+        time.sleep(0.2)
+        self.assertTrue(sink.thread.is_alive())
+        self.assertEqual(len(sink.buffer), 2)
+
+        # The records kept are written once it can be, with a count of the
+        # ones dropped
+        os.mkdir(os.path.dirname(path))
+        sink.wakeup.set()
+        time.sleep(0.2)
+        recs = self._read(path)
+        self.assertEqual([r['event']['i'] for r in recs[:2]], [0, 1])
+        self.assertEqual(recs[2]['dropped'], 1)
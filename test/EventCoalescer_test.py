@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import unittest
+from IndexRunner.EventCoalescer import coalesce
+
+
+def _ev(evtype, accgrp=1, objid=None, ver=None):
+    return {
+        'strcde': 'WS',
+        'accgrp': accgrp,
+        'objid': objid,
+        'ver': ver,
+        'evtype': evtype,
+        'objtype': 'KBaseNarrative.Narrative'
+    }
+
+
+class EventCoalescerTest(unittest.TestCase):
+
+    def test_latest_version(self):
+        evs = [_ev('NEW_VERSION', objid='2', ver=v) for v in [1, 2, 3]]
+        evs.append(_ev('NEW_VERSION', objid='3', ver=1))
+        kept, dropped = coalesce(evs)
+        self.assertEqual(kept, [evs[2], evs[3]])
+        self.assertEqual(dropped, evs[0:2])
+
+    def test_deleted(self):
+        evs = [
+            _ev('NEW_VERSION', objid='2', ver=1),
+            _ev('DELETE_ALL_VERSIONS', objid='2'),
+            _ev('NEW_VERSION', objid='3', ver=1),
+            _ev('DELETE_ALL_VERSIONS', objid='3'),
+            _ev('UNDELETE_ALL_VERSIONS', objid='3')
+        ]
+        kept, dropped = coalesce(evs)
+        self.assertEqual(dropped, [evs[0]])
+
+        # Workspace deletes drop everything before them
+        evs = [
+            _ev('NEW_VERSION', objid='2', ver=1),
+            _ev('NEW_VERSION', accgrp=2, objid='2', ver=1),
+            _ev('DELETE_ACCESS_GROUP')
+        ]
+        kept, dropped = coalesce(evs)
+        self.assertEqual(kept, evs[1:])
+
+    def test_publish(self):
+        evs = [
+            _ev('PUBLISH_ACCESS_GROUP'),
+            _ev('NEW_VERSION', objid='2', ver=1),
+            _ev('UNPUBLISH_ACCESS_GROUP'),
+            _ev('PUBLISH_ACCESS_GROUP', accgrp=2),
+            _ev('REINDEX_WORKSPACE'),
+            _ev('REINDEX_WORKSPACE')
+        ]
+        kept, dropped = coalesce(evs)
+        self.assertEqual(dropped, [evs[0], evs[4]])
+
+    def test_partial_reindex(self):
+        part = _ev('REINDEX_WORKSPACE')
+        part['start'] = 1001
+        evs = [_ev('REINDEX_WORKSPACE'), part, _ev('REINDEX_WORKSPACE')]
+        kept, dropped = coalesce(evs)
+        self.assertEqual(kept, [part, evs[2]])
+
+    def test_accessor(self):
+        recs = [(i, _ev('NEW_VERSION', objid='2', ver=i)) for i in [1, 2]]
+        kept, dropped = coalesce(recs, event=lambda r: r[1])
+        self.assertEqual(kept, [recs[1]])
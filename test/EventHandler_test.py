@@ -2,7 +2,11 @@
 import unittest
 from unittest.mock import patch
 import json
-from IndexRunner.EventUtils import kafka_watcher
+import threading
+import time
+import zlib
+from IndexRunner.EventUtils import kafka_watcher, EventLane
+from IndexRunner.EventProducer import EventProducer
 from confluent_kafka import KafkaError
 import os
 
@@ -20,9 +24,12 @@ class myerror():
 
 
 class mymessage():
-    def __init__(self, msg=None, error_code=None, err_string="error"):
+    def __init__(self, msg=None, error_code=None, err_string="error",
+                 topic='wsevents', partition=0, offset=0, headers=None):
         self.msg = msg
+        self.hdrs = headers
         self.err = None
+        self.tp = (topic, partition, offset)
         if error_code is not None:
             self.err = myerror(error_code, err_string)
 
@@ -34,6 +41,18 @@ class mymessage():
     def value(self):
         return self.msg
 
+    def headers(self):
+        return self.hdrs
+
+    def topic(self):
+        return self.tp[0]
+
+    def partition(self):
+        return self.tp[1]
+
+    def offset(self):
+        return self.tp[2]
+
 
 class MethodRunnerTest(unittest.TestCase):
 
@@ -61,9 +80,8 @@ class MethodRunnerTest(unittest.TestCase):
 
     def _parse_error(self):
         with open('error.log') as f:
-            data = f.readline()
-            error = f.readline()
-            return data, error
+            rec = json.loads(f.readline())
+            return rec['event'], rec['error']
 
     @patch('IndexRunner.EventUtils.Consumer', autospec=True)
     @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
@@ -102,8 +120,10 @@ class MethodRunnerTest(unittest.TestCase):
         kafka_watcher({'run_one': 1})
         mock_in.return_value.process_event.assert_not_called()
         self.assertTrue(os.path.exists('error.log'))
-        data, err = self._parse_error()
-        self.assertIn('Expecting value', err)
+        # The wording depends on which JSON parser is installed
+        with open('error.log') as f:
+            etype = json.loads(f.readline())['error_type']
+        self.assertIn(etype, ['JSONDecodeError', 'ValueError'])
 
         # Test index exception
         self._remove_error_file()
@@ -138,3 +158,263 @@ class MethodRunnerTest(unittest.TestCase):
         kafka_watcher({'run_one': 1})
         mock_in.return_value.process_event.assert_not_called()
         self.assertFalse(os.path.exists('error.log'))
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_workers(self, mock_log, mock_in, mock_con):
+        # The event is handed to a worker and the offset is only committed
+        # once it has been processed.
+        self._remove_error_file()
+        msg = mymessage(self.ev, offset=41)
+        mock_con.return_value.poll.return_value = msg
+        kafka_watcher({'run_one': 1, 'worker-threads': '4'})
+        self.assertEqual(mock_in.call_count, 4)
+        mock_in.return_value.process_event.assert_called_once()
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 42)
+        self.assertFalse(commit['asynchronous'])
+        self.assertFalse(os.path.exists('error.log'))
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_batch(self, mock_log, mock_in, mock_con):
+        self._remove_error_file()
+        msgs = [mymessage(self.ev, offset=1), mymessage(self.badev, offset=2),
+                mymessage(self.ev, offset=3)]
+        mock_con.return_value.consume.return_value = msgs
+        kafka_watcher({'run_one': 1, 'kafka-batch-size': '10'})
+        mock_con.return_value.consume.assert_called_with(10, 0.5)
+        mock_con.return_value.poll.assert_not_called()
+        mock_in.return_value.process_event.assert_not_called()
+        mock_in.return_value.process_events.assert_called_once()
+        events = mock_in.return_value.process_events.call_args[0][0]
+        self.assertEqual(len(events), 2)
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 4)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_bulk(self, mock_log, mock_in, mock_con):
+        mock_con.return_value.poll.return_value = None
+        log = mock_log.getLogger.return_value
+        # Bulk writes need batches to gather events from
+        kafka_watcher({'run_one': 1, 'es-bulk': 'true'})
+        log.warning.assert_called_once()
+        self.assertIn('kafka-batch-size', log.warning.call_args[0][0])
+        log.warning.reset_mock()
+        mock_con.return_value.consume.return_value = []
+        kafka_watcher({'run_one': 1, 'es-bulk': 'true',
+                       'kafka-batch-size': '10'})
+        log.warning.assert_not_called()
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_coalesce(self, mock_log, mock_in, mock_con):
+        ev = json.loads(self.ev.decode())
+        ev['ver'] = 4
+        msgs = [mymessage(self.ev, offset=1),
+                mymessage(json.dumps(ev).encode(), offset=2)]
+        mock_con.return_value.consume.return_value = msgs
+        kafka_watcher({'run_one': 1, 'kafka-batch-size': '10',
+                       'kafka-coalesce': 'true'})
+        mock_in.return_value.process_event.assert_called_once()
+        event = mock_in.return_value.process_event.call_args[0][0]
+        self.assertEqual(event['ver'], 4)
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 3)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_debounce(self, mock_log, mock_in, mock_con):
+        # Narratives are held and only the last save is indexed
+        ev = json.loads(self.ev.decode())
+        ev['ver'] = 4
+        msgs = [mymessage(self.ev, offset=1),
+                mymessage(json.dumps(ev).encode(), offset=2)]
+        mock_con.return_value.consume.return_value = msgs
+        kafka_watcher({'run_one': 1, 'kafka-batch-size': '10',
+                       'mapping-file': 'mapping.yaml'})
+        mock_in.return_value.process_event.assert_called_once()
+        event = mock_in.return_value.process_event.call_args[0][0]
+        self.assertEqual(event['ver'], 4)
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 3)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_backpressure(self, mock_log, mock_in, mock_con):
+        # The slow event is still in flight when the loop checks
+        msgs = [mymessage(self.ev, offset=1)]
+        mock_con.return_value.consume.return_value = msgs
+        mock_con.return_value.assignment.return_value = []
+        mock_in.return_value.process_event.side_effect = \
+            lambda ev: time.sleep(0.5)
+        kafka_watcher({'run_one': 1, 'kafka-batch-size': '10',
+                       'kafka-max-inflight': '1'})
+        mock_con.return_value.pause.assert_called_once()
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_lanes(self, mock_log, mock_in, mock_con):
+        msg = mymessage(self.ev)
+        mock_con.return_value.poll.return_value = msg
+        kafka_watcher({'run_one': 1, 'kafka-lanes': 'weighted',
+                       'worker-threads': '4'})
+        # 3 live workers, 1 reindex worker, a consumer per lane
+        self.assertEqual(mock_in.call_count, 4)
+        self.assertEqual(mock_con.call_count, 2)
+        topics = [c[0][0] for c in mock_con.return_value.subscribe.call_args_list]
+        self.assertIn(['wsevents'], topics)
+        self.assertIn(['idxevents'], topics)
+        self.assertEqual(mock_in.return_value.process_event.call_count, 2)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_lanes_interrupted(self, mock_log, mock_in, mock_con):
+        ev = json.loads(self.ev)
+        queued = []
+        for i in range(20):
+            ev['objid'] = str(i)
+            queued.append(mymessage(json.dumps(ev).encode(),
+                                    topic='idxevents', offset=i))
+
+        def poll(timeout):
+            if threading.current_thread() is threading.main_thread():
+                # The live lane gets a SIGTERM once the reindex lane has a
+                # queue of work
+                if len(queued) > 0:
+                    time.sleep(0.01)
+                    return None
+                raise SystemExit(1)
+            return queued.pop(0) if len(queued) > 0 else None
+        mock_con.return_value.poll.side_effect = poll
+        mock_in.return_value.process_event.side_effect = \
+            lambda evt: time.sleep(0.5)
+        start = time.time()
+        with self.assertRaises(SystemExit):
+            kafka_watcher({'kafka-lanes': 'weighted', 'worker-threads': '2'})
+        # The reindex lane dropped its queue instead of working through it
+        self.assertLess(time.time() - start, 3)
+        self.assertLess(mock_in.return_value.process_event.call_count, 5)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_workspace_order(self, mock_log, mock_in, mock_con):
+        lock = threading.Lock()
+        times = dict()
+
+        def process(evt):
+            start = time.time()
+            time.sleep(0.2)
+            with lock:
+                times[evt['objid']] = (start, time.time())
+        mock_in.return_value.process_event.side_effect = process
+        ev = json.loads(self.ev)
+
+        # Two objects that go to different workers
+        def worker(objid):
+            return zlib.crc32(('1/' + objid).encode()) % 4
+        a = '2'
+        b = [str(i) for i in range(3, 50) if worker(str(i)) != worker(a)][0]
+        msgs = []
+        for (i, objid) in enumerate([a, b, None, '99']):
+            evt = dict(ev, objid=objid)
+            if objid is None:
+                evt.update({'evtype': 'PUBLISH_ACCESS_GROUP', 'ver': None})
+            msgs.append(mymessage(json.dumps(evt).encode(), offset=i))
+        mock_con.return_value.consume.return_value = msgs
+        kafka_watcher({'run_one': 1, 'worker-threads': '4',
+                       'kafka-batch-size': '10'})
+        # Objects of a workspace run in parallel
+        self.assertLess(times[b][0], times[a][1])
+        # The publish waits for them, and the next object for the publish
+        self.assertGreaterEqual(times[None][0], max(times[a][1], times[b][1]))
+        self.assertGreaterEqual(times['99'][0], times[None][1])
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 4)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_lane_busy(self, mock_log, mock_in, mock_con):
+        lane = EventLane('live', {}, ['wsevents'], 1)
+        # A record held back (debounced or a retry) isn't work in flight
+        lane.tracker.add('wsevents', 0, 1)
+        self.assertFalse(lane.busy())
+        mock_in.return_value.process_event.side_effect = \
+            lambda evt: time.sleep(0.2)
+        record = ('wsevents', 0, 2, json.loads(self.ev))
+        lane._submit(lane.gate.admit([record]))
+        self.assertTrue(lane.busy())
+        lane.pool.join()
+        self.assertFalse(lane.busy())
+        lane.pool.shutdown()
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_lanes_reindex(self, mock_log, mock_in, mock_con,
+                                   mock_prod):
+        # Reindex events are produced to the topic the reindex lane reads
+        cfg = {'run_one': 1, 'kafka-lanes': 'strict', 'worker-threads': '2'}
+        mock_con.return_value.poll.return_value = mymessage(self.ev)
+        kafka_watcher(cfg)
+        (live, reindex) = [c[0][0] for c in
+                           mock_con.return_value.subscribe.call_args_list]
+        ep = EventProducer(cfg)
+        ep.reindex_workspace(1)
+        topic = ep.prod.produce.call_args[0][0]
+        self.assertIn(topic, reindex)
+        self.assertNotIn(topic, live)
+
+    @patch('IndexRunner.EventUtils.Consumer', autospec=True)
+    @patch('IndexRunner.EventUtils.IndexerUtils', autospec=True)
+    @patch('IndexRunner.EventUtils.EventProducer', autospec=True)
+    @patch('IndexRunner.EventUtils.logging', autospec=True)
+    def test_watcher_retry(self, mock_log, mock_ep, mock_in, mock_con):
+        cfg = {'run_one': 1, 'kafka-retry-topic': 'retries'}
+        msg = mymessage(self.ev)
+        mock_con.return_value.poll.return_value = msg
+        mock_in.return_value.process_event.return_value = False
+        kafka_watcher(cfg)
+        topics = mock_con.return_value.subscribe.call_args[0][0]
+        self.assertIn('retries', topics)
+        mock_ep.return_value.retry_events.assert_called_once()
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 1)
+
+        # Exceptions are retried too
+        mock_ep.return_value.retry_events.reset_mock()
+        mock_in.return_value.process_event.side_effect = Exception('bogus')
+        kafka_watcher(cfg)
+        mock_ep.return_value.retry_events.assert_called_once()
+
+        # The offset isn't moved on if the retry wasn't delivered
+        mock_con.return_value.commit.reset_mock()
+        mock_ep.return_value.retry_events.return_value = False
+        kafka_watcher(cfg)
+        commit = mock_con.return_value.commit.call_args[1]
+        self.assertEqual(commit['offsets'][0].offset, 0)
+        mock_ep.return_value.retry_events.return_value = True
+
+        # A retry that isn't due is held (and run here since run_one
+        # drains everything)
+        mock_in.return_value.process_event.reset_mock()
+        mock_in.return_value.process_event.side_effect = None
+        ev = json.loads(self.ev.decode())
+        ev['attempt'] = 1
+        ev['retry_at'] = time.time() + 600
+        mock_con.return_value.poll.return_value = \
+            mymessage(json.dumps(ev).encode(), topic='retries')
+        kafka_watcher(cfg)
+        mock_in.return_value.process_event.assert_called_once()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 import json
+import time
+from threading import Thread
 from IndexRunner.EventProducer import EventProducer
+from IndexRunner.Event import Event, msgpack
 import os
 
 
@@ -21,3 +24,164 @@ class EventProducerTest(unittest.TestCase):
         ep = EventProducer({})
         ep.index_objects(self.objects)
         ep.prod.produce.assert_called()
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_info(self, mock_prod):
+        ep = EventProducer({})
+        wsinfo = {'wsid': 1, 'public': True, 'temp': False, 'shared': False}
+        ep.index_objects(self.objects[:1], wsinfo=wsinfo)
+        evt = json.loads(ep.prod.produce.call_args[0][1].decode())
+        self.assertEqual(evt['info'], self.objects[0])
+        self.assertTrue(evt['public'])
+        self.assertEqual(evt['wsflags'],
+                         {'public': True, 'temp': False, 'shared': False})
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_reindex_workspace(self, mock_prod):
+        ep = EventProducer({})
+        ep.reindex_workspace(10, start=1001)
+        evt = json.loads(ep.prod.produce.call_args[0][1].decode())
+        self.assertEqual(evt['evtype'], 'REINDEX_WORKSPACE')
+        self.assertEqual(evt['accgrp'], 10)
+        self.assertEqual(evt['start'], 1001)
+        self.assertNotIn('index', evt)
+
+        ep.reindex_workspace(10, objtype='KBaseGenomes.Genome',
+                             index='genomefeature')
+        evt = json.loads(ep.prod.produce.call_args[0][1].decode())
+        self.assertEqual(evt['objtype'], 'KBaseGenomes.Genome')
+        self.assertEqual(evt['index'], 'genomefeature')
+        evts = ep.object_events(self.objects[:1], index='genomefeature')
+        self.assertEqual(evts[0]['index'], 'genomefeature')
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_encoding(self, mock_prod):
+        ep = EventProducer({'kafka-encoding': 'msgpack'})
+        ep.index_objects(self.objects[:1])
+        (args, kwargs) = ep.prod.produce.call_args
+        ev = Event.decode(args[1], kwargs.get('headers'))
+        self.assertEqual(ev['info'], self.objects[0])
+        self.assertIn('headers', kwargs)
+
+    @patch('IndexRunner.EventProducer.msgpack', None)
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_encoding_missing(self, mock_prod):
+        # Asking for msgpack without it installed is a startup error
+        with self.assertRaises(ValueError):
+            EventProducer({'kafka-encoding': 'msgpack'})
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_keys(self, mock_prod):
+        obj = self.objects[0]
+        ep = EventProducer({})
+        ep.index_objects([obj])
+        key = ep.prod.produce.call_args[1]['key']
+        self.assertEqual(key, str(obj[6]).encode())
+
+        ep = EventProducer({'kafka-index-key': 'object'})
+        ep.index_objects([obj])
+        key = ep.prod.produce.call_args[1]['key']
+        self.assertEqual(key, ('%s/%s' % (obj[6], obj[0])).encode())
+
+        ep = EventProducer({'kafka-index-key': 'none'})
+        ep.index_objects([obj])
+        self.assertIsNone(ep.prod.produce.call_args[1]['key'])
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_non_blocking(self, mock_prod):
+        ep = EventProducer({'kafka-producer-blocking': 'false',
+                            'kafka-compression': 'zstd'})
+        conf = mock_prod.call_args[0][0]
+        self.assertEqual(conf['compression.codec'], 'zstd')
+        ep.index_objects(self.objects)
+        self.assertEqual(ep.prod.produce.call_count, len(self.objects))
+        ep.prod.flush.assert_not_called()
+
+        # Delivery failures are counted and reported at the checkpoint
+        calls = ep.prod.produce.call_args_list
+        calls[0][1]['on_delivery'](None, None)
+        calls[1][1]['on_delivery']('timed out', Mock())
+        self.assertEqual(ep.checkpoint(), 1)
+        ep.prod.flush.assert_called_once()
+        self.assertEqual(ep.checkpoint(), 0)
+        self.assertEqual(ep.delivered, 1)
+
+        # Only the failures of the thread's own events count
+        ep.index_objects(self.objects[:1])
+        thread = Thread(target=ep.index_objects, args=[self.objects[:1]])
+        thread.start()
+        thread.join()
+        for c in ep.prod.produce.call_args_list[-2:]:
+            c[1]['on_delivery']('timed out', Mock())
+        self.assertEqual(ep.checkpoint(), 1)
+        self.assertEqual(ep.failed, 3)
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_queue_full(self, mock_prod):
+        ep = EventProducer({})
+        mock_prod.return_value.produce.side_effect = [BufferError(), None]
+        ep.index_objects(self.objects[:1])
+        self.assertEqual(ep.prod.produce.call_count, 2)
+        ep.prod.poll.assert_any_call(0.5)
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_retry(self, mock_prod):
+        ep = EventProducer({'kafka-retry-topic': 'retries',
+                            'kafka-dlq-topic': 'dead',
+                            'retry-max-attempts': '2',
+                            'retry-backoff': '10'})
+        evt = {'strcde': 'WS', 'accgrp': 1, 'objid': '2', 'ver': 3,
+               'evtype': 'NEW_VERSION'}
+        now = time.time()
+        ep.retry_event(evt, 'bogus')
+        (topic, data) = ep.prod.produce.call_args[0]
+        self.assertEqual(topic, 'retries')
+        retry = json.loads(data.decode())
+        self.assertEqual(retry['attempt'], 1)
+        self.assertEqual(retry['error'], 'bogus')
+        self.assertGreaterEqual(retry['retry_at'], now + 10)
+        self.assertNotIn('attempt', evt)
+
+        # Back off exponentially
+        ep.retry_event(retry, 'bogus')
+        retry = json.loads(ep.prod.produce.call_args[0][1].decode())
+        self.assertEqual(retry['attempt'], 2)
+        self.assertGreaterEqual(retry['retry_at'], now + 20)
+
+        # Out of attempts
+        ep.retry_event(retry, 'bogus')
+        self.assertEqual(ep.prod.produce.call_args[0][0], 'dead')
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_retry_no_topic(self, mock_prod):
+        ep = EventProducer({})
+        ep.log = Mock()
+        evt = {'strcde': 'WS', 'accgrp': 1, 'objid': '2', 'ver': 3,
+               'evtype': 'NEW_VERSION'}
+        ep.retry_event(evt, 'bogus')
+        ep.prod.produce.assert_not_called()
+        msg = ep.log.error.call_args[0][0]
+        self.assertIn('No retry topic', msg)
+        self.assertIn('1/2/3', msg)
+        self.assertIn('bogus', msg)
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_retry_events(self, mock_prod):
+        ep = EventProducer({'kafka-retry-topic': 'retries'})
+        evt = {'strcde': 'WS', 'accgrp': 1, 'objid': '2', 'ver': 3,
+               'evtype': 'NEW_VERSION'}
+        results = [None, 'timed out']
+
+        # Delivery results come back when the producer is flushed
+        def flush():
+            for c in ep.prod.produce.call_args_list:
+                c[1]['on_delivery'](results.pop(0), Mock())
+        ep.prod.flush.side_effect = flush
+        self.assertFalse(ep.retry_events([(evt, 'a'), (evt, 'b')]))
+        self.assertEqual(ep.failed, 1)
+        self.assertEqual(ep.delivered, 1)
+
+        ep.prod.produce.reset_mock()
+        results = [None]
+        self.assertTrue(ep.retry_events([(evt, 'a')]))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+from IndexRunner.Event import Event, encode, msgpack
+
+
+class EventTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+            'strcde': 'WS',
+            'accgrp': 1,
+            'objid': '2',
+            'ver': 3,
+            'newname': None,
+            'evtype': 'NEW_VERSION',
+            'time': '2018-02-08T23:23:25.553Z',
+            'objtype': 'KBaseNarrative.Narrative',
+            'objtypever': 4,
+            'public': False
+        }
+
+    def test_decode(self):
+        ev = Event.decode(json.dumps(self.data).encode('utf-8'))
+        self.assertEqual(ev['evtype'], 'NEW_VERSION')
+        self.assertEqual(ev['upa'], '1/2/3')
+        self.assertEqual(ev['eid'], 'WS:1:2:3')
+        self.assertTrue('upa' in ev)
+        self.assertFalse('attempt' in ev)
+        self.assertEqual(ev.get('retry_at', 0), 0)
+        with self.assertRaises(KeyError):
+            ev['attempt']
+
+    def test_missing(self):
+        del self.data['evtype']
+        with self.assertRaises(KeyError):
+            Event(self.data)
+        with self.assertRaises(ValueError):
+            Event.decode(b'blah')
+
+    def test_no_version(self):
+        self.data['evtype'] = 'PUBLISH_ACCESS_GROUP'
+        self.data['objid'] = None
+        self.data['ver'] = None
+        ev = Event(self.data)
+        self.assertIsNone(ev['upa'])
+        self.assertFalse('upa' in ev)
+        self.assertNotIn('upa', ev.to_dict())
+
+    def test_update(self):
+        ev = Event(self.data)
+        ev['ver'] = 5
+        self.assertEqual(ev['upa'], '1/2/5')
+        self.assertEqual(ev['eid'], 'WS:1:2:5')
+        ev['upa'] = '1/2/6'
+        self.assertEqual(ev['eid'], 'WS:1:2:6')
+        ev['attempt'] = 2
+        self.assertEqual(ev['attempt'], 2)
+
+    def test_round_trip(self):
+        self.data['attempt'] = 1
+        ev = Event(self.data)
+        d = dict(ev)
+        self.assertEqual(d['attempt'], 1)
+        self.assertEqual(d['upa'], '1/2/3')
+        copy = Event.decode(json.dumps(d))
+        self.assertEqual(copy, ev)
+        self.assertIsNot(ev.copy(), ev)
+        self.assertEqual(ev.copy(), ev)
+
+    def test_encode(self):
+        (data, headers) = encode(self.data)
+        self.assertIsNone(headers)
+        self.assertEqual(Event.decode(data, headers), Event(self.data))
+        with self.assertRaises(ValueError):
+            Event.decode(data, [('content-type', b'text/bogus')])
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack(self):
+        self.data['info'] = [1, 'name', 'Type-1.0', None]
+        (data, headers) = encode(self.data, 'msgpack')
+        self.assertEqual(headers, [('content-type', b'application/msgpack')])
+        ev = Event.decode(data, headers)
+        self.assertEqual(ev, Event(self.data))
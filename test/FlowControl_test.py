@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import Mock
+from confluent_kafka import TopicPartition
+from IndexRunner.FlowControl import FlowControl
+
+
+class FlowControlTest(unittest.TestCase):
+
+    def test_pause_resume(self):
+        consumer = Mock()
+        parts = [TopicPartition('wsevents', 0)]
+        consumer.assignment.return_value = parts
+        fc = FlowControl(consumer, high_water=10, low_water=2)
+        fc.update(5)
+        consumer.pause.assert_not_called()
+        fc.update(10)
+        consumer.pause.assert_called_once_with(parts)
+        self.assertTrue(fc.paused)
+        # Still above the low water mark
+        fc.update(5)
+        consumer.pause.assert_called_once()
+        consumer.resume.assert_not_called()
+
+        # A rebalance adds a partition while paused
+        parts2 = parts + [TopicPartition('wsevents', 1)]
+        consumer.assignment.return_value = parts2
+        fc.update(5)
+        consumer.pause.assert_called_with(parts2)
+
+        fc.update(2)
+        consumer.resume.assert_called_once_with(parts2)
+        self.assertFalse(fc.paused)
+
+    def test_hold(self):
+        consumer = Mock()
+        consumer.assignment.return_value = []
+        fc = FlowControl(consumer, high_water=10)
+        fc.update(0, hold=True)
+        self.assertTrue(fc.paused)
+        fc.update(0, hold=True)
+        self.assertTrue(fc.paused)
+        fc.update(0)
+        self.assertFalse(fc.paused)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import Mock
+from confluent_kafka import TopicPartition
+from IndexRunner.OffsetTracker import OffsetTracker, OffsetCommitter
+
+
+class OffsetTrackerTest(unittest.TestCase):
+
+    def test_out_of_order(self):
+        ot = OffsetTracker()
+        for offset in [10, 11, 12]:
+            ot.add('wsevents', 0, offset)
+        self.assertEqual(ot.inflight(), 3)
+        self.assertEqual(ot.committable(), [('wsevents', 0, 10)])
+
+        # Finishing a later message doesn't move the position
+        ot.done('wsevents', 0, 12)
+        self.assertEqual(ot.committable(), [])
+        ot.done('wsevents', 0, 10)
+        self.assertEqual(ot.committable(), [('wsevents', 0, 11)])
+        ot.done('wsevents', 0, 11)
+        self.assertEqual(ot.committable(), [('wsevents', 0, 13)])
+        self.assertEqual(ot.inflight(), 0)
+
+    def test_forget(self):
+        ot = OffsetTracker()
+        ot.add('wsevents', 0, 1)
+        ot.add('wsevents', 1, 5)
+        ot.forget([('wsevents', 0)])
+        ot.done('wsevents', 0, 1)
+        ot.done('wsevents', 1, 5)
+        self.assertEqual(ot.committable(), [('wsevents', 1, 6)])
+
+    def test_committer(self):
+        consumer = Mock()
+        ot = OffsetTracker()
+        oc = OffsetCommitter(consumer, ot, commit_count=2,
+                             commit_interval=1000)
+        for offset in range(3):
+            ot.add('wsevents', 0, offset)
+        ot.done('wsevents', 0, 0)
+        oc.maybe_commit()
+        consumer.commit.assert_not_called()
+        ot.done('wsevents', 0, 1)
+        oc.maybe_commit()
+        args = consumer.commit.call_args[1]
+        self.assertTrue(args['asynchronous'])
+        self.assertEqual(args['offsets'][0].offset, 2)
+
+        # Revoking commits synchronously and forgets the partition
+        consumer.reset_mock()
+        ot.done('wsevents', 0, 2)
+        oc.on_revoke(consumer, [TopicPartition('wsevents', 0)])
+        args = consumer.commit.call_args[1]
+        self.assertFalse(args['asynchronous'])
+        self.assertEqual(args['offsets'][0].offset, 3)
+        self.assertEqual(ot.committable(), [])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch, Mock
+import time
+from IndexRunner.RateLimiter import (TokenBucket, AdaptiveTokenBucket,
+                                     consumer_lag, rate_limiter,
+                                     shared_rate_limiter)
+from IndexRunner.EventProducer import EventProducer
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_bucket(self):
+        bucket = TokenBucket(100, burst=10)
+        # The burst goes straight through
+        for i in range(10):
+            self.assertEqual(bucket.wait_time(), 0)
+        self.assertGreater(bucket.wait_time(), 0)
+        start = time.time()
+        for i in range(20):
+            bucket.acquire()
+        elapsed = time.time() - start
+        self.assertGreater(elapsed, 0.15)
+        self.assertLess(elapsed, 1.0)
+
+    def test_adaptive(self):
+        lag = [0]
+        bucket = AdaptiveTokenBucket(100, lambda: lag[0], 1000,
+                                     min_rate=5, check_interval=0)
+        bucket.wait_time()
+        self.assertEqual(bucket.rate, 100)
+        lag[0] = 4000
+        bucket.wait_time()
+        self.assertEqual(bucket.rate, 25)
+        lag[0] = 1000000
+        bucket.wait_time()
+        self.assertEqual(bucket.rate, 5)
+        lag[0] = 10
+        bucket.wait_time()
+        self.assertEqual(bucket.rate, 100)
+
+    def test_adaptive_lag_error(self):
+        bucket = AdaptiveTokenBucket(100, Mock(side_effect=Exception('x')),
+                                     1000, check_interval=0)
+        bucket.wait_time()
+        self.assertEqual(bucket.rate, 100)
+
+    def test_consumer_lag(self):
+        consumer = Mock()
+        consumer.list_topics.return_value.topics = \
+            {'idxevents': Mock(partitions={0: None, 1: None})}
+        committed = [Mock(offset=90), Mock(offset=-1001)]
+        consumer.committed.return_value = committed
+        consumer.get_watermark_offsets.side_effect = [(0, 100), (20, 50)]
+        self.assertEqual(consumer_lag(consumer, 'idxevents'), 40)
+
+    @patch('IndexRunner.RateLimiter.Consumer', autospec=True)
+    def test_config(self, mock_con):
+        self.assertIsNone(rate_limiter({}))
+        bucket = rate_limiter({'reindex-rate': '50', 'reindex-burst': '5'})
+        self.assertEqual(bucket.rate, 50)
+        self.assertEqual(bucket.burst, 5)
+        bucket = rate_limiter({'reindex-rate': '50',
+                               'reindex-target-lag': '100'})
+        self.assertIsInstance(bucket, AdaptiveTokenBucket)
+        mock_con.assert_not_called()
+
+    @patch('IndexRunner.EventProducer.Producer', autospec=True)
+    def test_shared(self, mock_prod):
+        config = {'reindex-rate': '1000', 'reindex-burst': '10'}
+        self.assertIs(shared_rate_limiter(config), shared_rate_limiter(config))
+        (ep1, ep2) = (EventProducer(config), EventProducer(config))
+        self.assertIs(ep1.limiter, ep2.limiter)
+        # Two producers draw on one budget
+        for i in range(5):
+            self.assertEqual(ep1.limiter.wait_time(), 0)
+            self.assertEqual(ep2.limiter.wait_time(), 0)
+        self.assertGreater(ep2.limiter.wait_time(), 0)
+        other = shared_rate_limiter({'reindex-rate': '1000'})
+        self.assertIsNot(other, ep1.limiter)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import unittest
+from IndexRunner.RefreshPolicy import RefreshPolicy, event_kind
+
+
+class RefreshPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mapping = {
+            'KBaseGenomes.Genome': [
+                {'index_name': 'ci.genome'},
+                {'index_name': 'ci.genomefeature', 'refresh': 'batch'}
+            ],
+            'Other': [{'index_name': 'ci.objects', 'refresh': False}]
+        }
+        self.live = {'evtype': 'NEW_VERSION'}
+        self.reindex = {'evtype': 'NEW_VERSION', 'info': [1]}
+
+    def test_default(self):
+        policy = RefreshPolicy.from_config({}, {})
+        self.assertEqual(policy.policy('ci.genome', self.live), 'true')
+        self.assertEqual(policy.policy('ci.genome'), 'true')
+
+    def test_config(self):
+        cfg = {'es-refresh': 'wait_for',
+               'es-refresh-events': 'REINDEX:none, DELETE_ALL_VERSIONS:true'}
+        policy = RefreshPolicy.from_config(cfg, self.mapping)
+        self.assertEqual(policy.policy('ci.genome', self.live), 'wait_for')
+        self.assertEqual(policy.policy('ci.genomefeature', self.live),
+                         'batch')
+        self.assertEqual(policy.policy('ci.objects', self.live), 'none')
+        # The event's policy wins
+        self.assertEqual(policy.policy('ci.genomefeature', self.reindex),
+                         'none')
+        delete = {'evtype': 'DELETE_ALL_VERSIONS'}
+        self.assertEqual(policy.policy('ci.objects', delete), 'true')
+
+    def test_bad(self):
+        with self.assertRaises(ValueError):
+            RefreshPolicy('sometimes')
+
+    def test_args(self):
+        self.assertEqual(event_kind(self.reindex), 'REINDEX')
+        self.assertEqual(event_kind(self.live), 'NEW_VERSION')
+        arg = RefreshPolicy.refresh_arg
+        self.assertEqual(arg('true'), 'true')
+        self.assertEqual(arg('wait_for'), 'wait_for')
+        self.assertEqual(arg('wait_for', by_query=True), 'true')
+        self.assertEqual(arg('none'), 'false')
+        self.assertEqual(arg('batch'), 'false')
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch
+import json
+import os
+import shutil
+import tempfile
+from IndexRunner.Reindexer import Reindexer, Checkpoint, main
+
+
+class ReindexerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_dir = os.path.dirname(os.path.abspath(__file__))
+        cls.mock_dir = os.path.join(cls.test_dir, 'mock_data')
+        with open(cls.mock_dir + '/list_objects.json') as f:
+            cls.objects = json.loads(f.read())
+        with open(cls.mock_dir + '/get_workspace_info.json') as f:
+            cls.wsinfo = json.loads(f.read())
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'reindex.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_checkpoint(self):
+        ck = Checkpoint(self.path, interval=0)
+        ck.progress(3, 101)
+        ck.finish(1)
+        ck.finish(4)
+        ck.compact([1, 3, 4, 5])
+        ck.save(force=True)
+
+        ck = Checkpoint(self.path)
+        self.assertEqual(ck.last_wsid, 1)
+        self.assertIsNone(ck.start_for(1))
+        self.assertEqual(ck.start_for(3), 101)
+        self.assertIsNone(ck.start_for(4))
+        self.assertEqual(ck.start_for(5), 0)
+
+    @patch('IndexRunner.Reindexer.EventProducer', autospec=True)
+    @patch('IndexRunner.Reindexer.WorkspaceAdminUtil', autospec=True)
+    def test_run(self, mock_ws, mock_ep):
+        ws = mock_ws.return_value
+        ws.list_workspace_ids.return_value = {'workspaces': [3, 1],
+                                              'pub': [2, 3]}
+        ws.get_workspace_info.return_value = self.wsinfo
+        # Workspace 1 has two pages, the others one short page each
+        pages = {1: [self.objects[:4], self.objects[4:6]],
+                 2: [self.objects[:1]], 3: [[]]}
+
+        def list_objects(params):
+            wsid = params['ids'][0]
+            return pages[wsid].pop(0)
+        ws.list_objects.side_effect = list_objects
+        ep = mock_ep.return_value
+        ep.checkpoint.return_value = 0
+
+        reindexer = Reindexer({'reindex-page-size': '4'},
+                              Checkpoint(self.path), threads=2)
+        self.assertEqual(reindexer.run(), [])
+        # A producer per thread
+        self.assertEqual(len(reindexer.producers), mock_ep.call_count)
+        self.assertLessEqual(mock_ep.call_count, 2)
+        self.assertEqual(ep.index_objects.call_count, 4)
+        self.assertEqual(ws.list_objects.call_count, 4)
+        with open(self.path) as f:
+            state = json.load(f)
+        self.assertEqual(state['last_wsid'], 3)
+        self.assertEqual(state['partial'], {})
+
+        # Everything is done so a rerun has nothing to do
+        ws.list_objects.reset_mock()
+        Reindexer({}, Checkpoint(self.path)).run()
+        ws.list_objects.assert_not_called()
+
+    @patch('IndexRunner.Reindexer.EventProducer', autospec=True)
+    @patch('IndexRunner.Reindexer.WorkspaceAdminUtil', autospec=True)
+    def test_some_workspaces(self, mock_ws, mock_ep):
+        ws = mock_ws.return_value
+        ws.get_workspace_info.return_value = self.wsinfo
+        ws.list_objects.return_value = []
+        mock_ep.return_value.checkpoint.return_value = 0
+        reindexer = Reindexer({}, Checkpoint(self.path), threads=1)
+        self.assertEqual(reindexer.run([5, 100]), [])
+        # Only the listed workspaces are done, not everything below them
+        ck = Checkpoint(self.path)
+        self.assertIsNone(ck.last_wsid)
+        self.assertIsNone(ck.start_for(100))
+        self.assertEqual(ck.start_for(42), 0)
+
+    @patch('IndexRunner.Reindexer.EventProducer', autospec=True)
+    @patch('IndexRunner.Reindexer.WorkspaceAdminUtil', autospec=True)
+    def test_resume(self, mock_ws, mock_ep):
+        ck = Checkpoint(self.path, interval=0)
+        ck.progress(7, 500)
+        ws = mock_ws.return_value
+        ws.get_workspace_info.return_value = self.wsinfo
+        ws.list_objects.return_value = []
+        ep = mock_ep.return_value
+        ep.checkpoint.return_value = 1
+        reindexer = Reindexer({}, Checkpoint(self.path), threads=1)
+        # Undelivered events fail the workspace and keep its progress
+        self.assertEqual(reindexer.run([7]), [7])
+        self.assertEqual(ws.list_objects.call_args[0][0]['minObjectID'], 500)
+        self.assertEqual(Checkpoint(self.path).start_for(7), 500)
+
+    @patch('IndexRunner.Reindexer.EventProducer', autospec=True)
+    @patch('IndexRunner.Reindexer.WorkspaceAdminUtil', autospec=True)
+    def test_type(self, mock_ws, mock_ep):
+        ws = mock_ws.return_value
+        ws.get_workspace_info.return_value = self.wsinfo
+        ws.list_objects.return_value = []
+        mock_ep.return_value.checkpoint.return_value = 0
+        reindexer = Reindexer({}, Checkpoint(None), threads=1,
+                              objtype='KBaseGenomes.Genome',
+                              index='genomefeature')
+        self.assertEqual(reindexer.run([1]), [])
+        params = ws.list_objects.call_args[0][0]
+        self.assertEqual(params['type'], 'KBaseGenomes.Genome')
+        index = mock_ep.return_value.index_objects.call_args[1]['index']
+        self.assertEqual(index, 'genomefeature')
+
+    @patch('IndexRunner.Reindexer._read_config')
+    @patch('IndexRunner.Reindexer.Checkpoint')
+    @patch('IndexRunner.Reindexer.Reindexer')
+    def test_checkpoint_name(self, mock_re, mock_ck, mock_cfg):
+        mock_re.return_value.run.return_value = []
+        args = ['--config', 'deploy.cfg', '--type', 'KBaseGenomes.Genome']
+        main(args)
+        self.assertEqual(mock_ck.call_args[0][0],
+                         'reindex-KBaseGenomes.Genome.checkpoint')
+        # Each index of the type has its own progress
+        main(args + ['--index', 'genomefeature'])
+        self.assertEqual(mock_ck.call_args[0][0],
+                         'reindex-KBaseGenomes.Genome-genomefeature.checkpoint')
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import Mock
+import json
+import os
+import tempfile
+from IndexRunner.Replay import replay, read_events, percentile
+
+
+class ReplayTest(unittest.TestCase):
+
+    def _events(self):
+        evs = []
+        for i in range(10):
+            evs.append({'strcde': 'WS', 'accgrp': 1, 'objid': str(i),
+                        'ver': 1, 'evtype': 'NEW_VERSION',
+                        'objtype': 'KBaseNarrative.Narrative'})
+        evs.append({'strcde': 'WS', 'accgrp': 1, 'objid': None,
+                    'ver': None, 'evtype': 'PUBLISH_ACCESS_GROUP',
+                    'objtype': None})
+        return evs
+
+    def test_read(self):
+        (fd, path) = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            for ev in self._events():
+                f.write(json.dumps(ev) + '\n')
+            f.write('\n')
+        evs = list(read_events(path))
+        os.remove(path)
+        self.assertEqual(len(evs), 11)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        vals = list(range(101))
+        self.assertEqual(percentile(vals, 50), 50)
+        self.assertEqual(percentile(vals, 99), 99)
+
+    def test_replay(self):
+        indexer = Mock()
+
+        def process(ev):
+            if ev['objid'] == '3':
+                raise ValueError('bogus')
+            return ev['objid'] != '4'
+        indexer.process_event.side_effect = process
+        stats = replay(indexer, self._events())
+        rep = stats.report()
+        self.assertEqual(rep['events'], 11)
+        self.assertEqual(rep['failures'], 2)
+        self.assertEqual(rep['types']['NEW_VERSION']['failures'], 2)
+        self.assertEqual(rep['types']['PUBLISH_ACCESS_GROUP']['count'], 1)
+        self.assertIn('events/sec', stats.format())
+
+    def test_replay_batch(self):
+        indexer = Mock()
+        evs = self._events()
+        indexer.process_events.side_effect = \
+            lambda batch: [(ev, 'bogus') for ev in batch if ev['objid'] == '1']
+        stats = replay(indexer, evs, batch_size=4, limit=8)
+        self.assertEqual(indexer.process_events.call_count, 2)
+        self.assertEqual(stats.report()['failures'], 1)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch
+import os
+import time
+from IndexRunner.Supervisor import Supervisor
+
+
+def _sleeper(config):
+    time.sleep(60)
+
+
+def _quitter(config):
+    return
+
+
+class SupervisorTest(unittest.TestCase):
+
+    @patch('IndexRunner.Supervisor.Process', autospec=True)
+    def test_restart(self, mock_proc):
+        sup = Supervisor(_sleeper, {}, 3)
+        sup.start()
+        self.assertEqual(mock_proc.call_count, 3)
+        mock_proc.return_value.is_alive.return_value = True
+        sup.check()
+        self.assertEqual(mock_proc.call_count, 3)
+        mock_proc.return_value.is_alive.return_value = False
+        sup.check()
+        self.assertEqual(mock_proc.call_count, 6)
+
+    def test_processes(self):
+        sup = Supervisor(_sleeper, {}, 2, shutdown_timeout=10)
+        sup.start()
+        pids = [p.pid for p in sup.procs]
+        self.assertNotIn(os.getpid(), pids)
+        sup.check()
+        self.assertEqual([p.pid for p in sup.procs], pids)
+        # Give the workers time to install their signal handlers
+        time.sleep(0.5)
+        start = time.time()
+        sup.shutdown()
+        self.assertLess(time.time() - start, 10)
+        for p in sup.procs:
+            self.assertFalse(p.is_alive())
+            self.assertEqual(p.exitcode, 0)
+
+        # A worker that exits is replaced
+        sup = Supervisor(_quitter, {}, 1)
+        sup.start()
+        old = sup.procs[0]
+        old.join()
+        sup.check()
+        self.assertIsNot(sup.procs[0], old)
+        sup.shutdown()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import unittest
+import time
+from threading import Lock
+from IndexRunner.WorkerPool import WorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_ordering(self):
+        lock = Lock()
+        seen = dict()
+        done = []
+
+        def handler(item):
+            (key, seq) = item
+            with lock:
+                seen.setdefault(key, []).append(seq)
+
+        pool = WorkerPool([handler] * 4, callback=done.append)
+        for seq in range(50):
+            for key in ['1/1', '1/2', '2/7']:
+                pool.submit(key, (key, seq))
+        pool.shutdown()
+        for key in ['1/1', '1/2', '2/7']:
+            self.assertEqual(seen[key], list(range(50)))
+        self.assertEqual(len(done), 150)
+
+    def test_handler_error(self):
+        done = []
+
+        def handler(item):
+            raise ValueError('bogus')
+
+        pool = WorkerPool([handler], callback=done.append)
+        pool.submit('1/1', 'a')
+        pool.join()
+        self.assertEqual(done, ['a'])
+        pool.shutdown()
+
+    def test_submit_many(self):
+        seen = []
+        pool = WorkerPool([seen.append] * 2)
+        items = [('1/%d' % (i % 5), i) for i in range(20)]
+        pool.submit_many(items)
+        pool.shutdown()
+        self.assertLessEqual(len(seen), 2)
+        for group in seen:
+            self.assertEqual(group, sorted(group))
+        self.assertEqual(sorted(sum(seen, [])), list(range(20)))
+
+    def test_discard(self):
+        done = []
+        pool = WorkerPool([lambda item: time.sleep(0.2)], callback=done.append)
+        for i in range(5):
+            pool.submit('1/1', i)
+        time.sleep(0.1)
+        pool.shutdown(discard=True)
+        self.assertEqual(done, [0])
+
+    def test_pending(self):
+        started = Lock()
+        started.acquire()
+        release = Lock()
+        release.acquire()
+
+        def handler(item):
+            started.release()
+            release.acquire()
+
+        pool = WorkerPool([handler])
+        self.assertEqual(pool.pending(), 0)
+        pool.submit('1/1', 'a')
+        pool.submit_many([('1/1', 'b')])
+        started.acquire()
+        # One running, one queued
+        self.assertEqual(pool.pending(), 2)
+        release.release()
+        started.acquire()
+        release.release()
+        pool.join()
+        self.assertEqual(pool.pending(), 0)
+        pool.shutdown()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import unittest
+from IndexRunner.WorkspaceGate import WorkspaceGate, is_workspace_event
+
+
+class WorkspaceGateTest(unittest.TestCase):
+
+    def _ev(self, objid, evtype='NEW_VERSION', accgrp=1):
+        return {'evtype': evtype, 'accgrp': accgrp, 'objid': objid}
+
+    def test_objects(self):
+        gate = WorkspaceGate()
+        (a, b) = (self._ev('2'), self._ev('3'))
+        # Objects of a workspace don't wait for each other
+        self.assertEqual(gate.admit([a, b]), [a, b])
+        self.assertEqual(gate.done([a, b]), [])
+        self.assertEqual(len(gate), 0)
+
+    def test_barrier(self):
+        gate = WorkspaceGate()
+        (a, b) = (self._ev('2'), self._ev('3'))
+        pub = self._ev(None, evtype='PUBLISH_ACCESS_GROUP')
+        c = self._ev('4')
+        other = self._ev('2', accgrp=5)
+        self.assertEqual(gate.admit([a, b, pub, c, other]), [a, b, other])
+        self.assertEqual(len(gate), 2)
+        # The publish waits for both objects
+        self.assertEqual(gate.done([a]), [])
+        self.assertEqual(gate.done([b]), [pub])
+        # and the object after it for the publish
+        self.assertEqual(gate.admit([self._ev('2')]), [])
+        self.assertEqual(gate.done([pub]), [c, self._ev('2')])
+        self.assertEqual(gate.done([c, self._ev('2'), other]), [])
+        self.assertEqual(len(gate), 0)
+
+    def test_is_workspace_event(self):
+        for evtype in ['PUBLISH_ACCESS_GROUP', 'DELETE_ACCESS_GROUP',
+                       'COPY_ACCESS_GROUP', 'REINDEX_WORKSPACE']:
+            self.assertTrue(is_workspace_event(self._ev(None, evtype)))
+        self.assertFalse(is_workspace_event(self._ev('2', 'DELETE_OBJECT')))
@@ -12,6 +12,7 @@ from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 
 from IndexRunner.IndexerUtils import IndexerUtils
+from IndexRunner.ErrorSink import error_sink
 import datetime
 
 
@@ -257,6 +258,7 @@ class IndexerTester(unittest.TestCase):
         iu._new_object_version_feature_index = Mock(side_effect=KeyError())
         ev = self.new_version_event.copy()
         iu.process_event(ev)
+        error_sink().flush()
         self.assertTrue(os.path.exists('error.log'))
 
     @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
@@ -376,7 +378,8 @@ class IndexerTester(unittest.TestCase):
             "public": False
         }
         iu = IndexerUtils(self.cfg)
-        iu.ws.list_objects.return_value = self.wslist
+        iu.ws.iter_pages.return_value = [self.wslist]
+        iu.ep.checkpoint.return_value = 0
         iu.process_event(ev)
         iu.ep.index_objects.assert_called()
 
@@ -396,10 +399,16 @@ class IndexerTester(unittest.TestCase):
             "public": False
         }
         iu = IndexerUtils(self.cfg)
-        iu.ws.list_objects.return_value = self.wslist
+        iu.ws.iter_pages.return_value = [self.wslist]
+        iu.ep.checkpoint.return_value = 0
         iu.process_event(ev)
         iu.ep.index_objects.assert_called()
 
+        # Undelivered events fail the reindex so it gets retried
+        iu.ep.checkpoint.return_value = 2
+        with self.assertRaises(IOError):
+            iu.process_event(ev)
+
     @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
     @patch('IndexRunner.IndexerUtils.MethodRunner', autospec=True)
     def index_raw_test(self, mock_wsa, mock_cat):
@@ -442,3 +451,302 @@ class IndexerTester(unittest.TestCase):
         ev['ver'] = 2
         iu.mr.run.return_value = [{}]
         iu.process_event(ev)
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def process_events_test(self, mock_ws):
+        iu = IndexerUtils(self.cfg)
+        iu.es = Mock()
+        iu.es.mget.return_value = {'docs': [
+            {'_index': self._iname('objects'), '_type': 'access',
+             '_id': 'WS:1:2:3', 'found': True},
+            {'_index': self._iname('objects'), '_type': 'access',
+             '_id': 'WS:1:3:3', 'found': True}
+        ]}
+        iu.es.indices.get.return_value = {self._iname('objects'): {}}
+        iu.ws.get_workspace_info.return_value = self.wsinfo
+        ev1 = self.new_version_event.copy()
+        ev1['objtype'] = 'Blah.Blah'
+        ev2 = ev1.copy()
+        ev2['objid'] = '3'
+        pub = ev1.copy()
+        pub['evtype'] = 'PUBLISH_ACCESS_GROUP'
+        pub['objid'] = None
+        pub['ver'] = None
+        iu.process_events([ev1, ev2, pub, pub.copy()])
+        # One lookup for the batch, no per-object checks
+        iu.es.mget.assert_called_once()
+        iu.es.get.assert_not_called()
+        iu.es.create.assert_not_called()
+        # Publish always re-reads the workspace but indexes are shared
+        self.assertEqual(iu.ws.get_workspace_info.call_count, 2)
+        iu.es.indices.get.assert_called_once()
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def event_info_test(self, mock_ws):
+        # Reindex events carry the object info and workspace flags
+        iu = IndexerUtils(self.cfg)
+        iu.ws.get_objects2.return_value = self.narobj
+        ev = self.new_version_event.copy()
+        ev['info'] = self.narobj['data'][0]['info']
+        ev['wsflags'] = {'public': True, 'temp': False, 'shared': False}
+        rec = iu._create_obj_rec('1/2/3', ev)
+        self.assertTrue(rec['public'])
+        iu.es = Mock()
+        iu.es.count.return_value = {'count': 0}
+        index = self._iname('narrative')
+        self.assertEqual(iu._latest_info(ev, index), ev['info'])
+        iu.ws.get_workspace_info.assert_not_called()
+        iu.ws.get_object_info3.assert_not_called()
+
+        # A newer version has been indexed since the object was listed
+        iu.es.count.return_value = {'count': 1}
+        latest = list(ev['info'])
+        latest[4] += 1
+        iu.ws.get_object_info3.return_value = {'infos': [latest]}
+        self.assertEqual(iu._latest_info(ev, index), latest)
+        q = iu.es.count.call_args[1]['body']['query']['bool']['filter']
+        self.assertEqual(q[1]['range']['version']['gt'], ev['info'][4])
+
+        ev['wsflags']['temp'] = True
+        self.assertIsNone(iu._create_obj_rec('1/2/3', ev))
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    @patch('IndexRunner.IndexerUtils.EventProducer', autospec=True)
+    def direct_reindex_test(self, mock_ep, mock_ws):
+        cfg = self.cfg.copy()
+        cfg['reindex-mode'] = 'direct'
+        cfg['reindex-page-size'] = '8'
+        cfg['reindex-batch-size'] = '3'
+        iu = IndexerUtils(cfg)
+        iu.ws.list_objects.return_value = self.wslist
+        iu.ws.get_workspace_info.return_value = self.wsinfo
+        iu.ep.object_events.return_value = [{'objid': str(o[0])}
+                                            for o in self.wslist]
+        iu.ep.checkpoint.return_value = 0
+        iu.process_events = Mock(return_value=[])
+        ev = {
+            "strcde": "WS",
+            "accgrp": 1,
+            "objid": None,
+            "ver": None,
+            "evtype": "REINDEX_WORKSPACE",
+            "objtype": None,
+            "start": 5
+        }
+        iu.process_event(ev)
+        params = iu.ws.list_objects.call_args[0][0]
+        self.assertEqual(params['minObjectID'], 5)
+        self.assertEqual(params['limit'], 8)
+        # Indexed here in batches, nothing produced per object
+        self.assertEqual(iu.process_events.call_count, 3)
+        iu.ep.index_objects.assert_not_called()
+        # A full page leaves the rest to a new event
+        iu.ep.reindex_workspace.assert_called_with(
+            1, self.wslist[-1][0] + 1, objtype=None, index=None)
+
+        # A short page is the end of the workspace
+        iu.ep.reindex_workspace.reset_mock()
+        iu.ws.list_objects.return_value = self.wslist[:2]
+        iu.process_event(ev)
+        iu.ep.reindex_workspace.assert_not_called()
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    @patch('IndexRunner.IndexerUtils.EventProducer', autospec=True)
+    def targeted_reindex_test(self, mock_ep, mock_ws):
+        iu = IndexerUtils(self.cfg)
+        ev = self.new_version_event.copy()
+        ev['objtype'] = 'KBaseGenomes.Genome'
+        self.assertEqual(len(iu._event_indexes(ev)), 2)
+        ev['index'] = 'genomefeature'
+        indexes = iu._event_indexes(ev)
+        self.assertEqual(len(indexes), 1)
+        self.assertEqual(indexes[0]['index_name'],
+                         self._iname('genomefeature'))
+
+        # Only the named index is updated
+        iu._new_object_version_multi_index = Mock()
+        iu._new_object_version_index = Mock()
+        iu.process_event(ev)
+        iu._new_object_version_multi_index.assert_called_once()
+        iu._new_object_version_index.assert_not_called()
+
+        # A reindex event with a type only lists that type
+        iu.ws.iter_pages.return_value = [[]]
+        iu.ep.checkpoint.return_value = 0
+        rev = {'strcde': 'WS', 'accgrp': 1, 'objid': None, 'ver': None,
+               'evtype': 'REINDEX_WORKSPACE', 'objtype': 'KBaseGenomes.Genome',
+               'index': 'genomefeature'}
+        iu.process_event(rev)
+        params = iu.ws.iter_pages.call_args[0][1]
+        self.assertEqual(params['type'], 'KBaseGenomes.Genome')
+        self.assertEqual(iu.ep.index_objects.call_args[1]['index'],
+                         'genomefeature')
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    @patch('IndexRunner.IndexerUtils.EventProducer', autospec=True)
+    def skip_indexed_test(self, mock_ep, mock_ws):
+        cfg = self.cfg.copy()
+        cfg['reindex-skip-indexed'] = 'true'
+        iu = IndexerUtils(cfg)
+        iu.es = Mock()
+        objs = self.wslist[:3]
+        events = []
+        for o in objs:
+            ev = self.new_version_event.copy()
+            (ev['accgrp'], ev['objid'], ev['ver']) = (o[6], str(o[0]), o[4])
+            events.append(ev)
+        iu.ep.object_events.return_value = events
+        eids = ['WS:%d:%d:%d' % (o[6], o[0], o[4]) for o in objs]
+        iu.es.mget.return_value = {'docs': [
+            {'_index': self._iname('narrative'), '_type': 'access',
+             '_id': eids[0], 'found': True},
+            {'_index': self._iname('narrative'), '_type': 'access',
+             '_id': eids[1], 'found': False},
+            {'_index': self._iname('narrative'), '_type': 'access',
+             '_id': eids[2], 'found': True}
+        ]}
+        iu.ws.iter_pages.return_value = [objs]
+        iu.ep.checkpoint.return_value = 0
+        iu._index_workspace(1)
+        iu.es.mget.assert_called_once()
+        self.assertEqual(iu.ep.index_objects.call_args[0][0], [objs[1]])
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def refresh_policy_test(self, mock_ws):
+        cfg = self.cfg.copy()
+        cfg['es-refresh'] = 'batch'
+        iu = IndexerUtils(cfg)
+        iu.es = Mock()
+        iu.es.indices.get.return_value = {self._iname('objects'): {},
+                                          self._iname('genome'): {}}
+        ev = self.new_version_event.copy()
+        ev['evtype'] = 'DELETE_ALL_VERSIONS'
+        ev2 = ev.copy()
+        ev2['objid'] = '3'
+        iu.process_events([ev, ev2])
+        # No refresh per write, one before the second event's delete by
+        # query and one for the batch
+        for call in iu.es.delete.call_args_list:
+            self.assertEqual(call[1]['refresh'], 'false')
+        self.assertEqual(iu.es.indices.refresh.call_count, 2)
+        indexes = iu.es.indices.refresh.call_args[1]['index'].split(',')
+        self.assertEqual(sorted(indexes),
+                         [self._iname('genome'), self._iname('objects')])
+
+        # A single event refreshes when it's done
+        iu.es.indices.refresh.reset_mock()
+        iu.process_event(ev)
+        iu.es.indices.refresh.assert_called_once()
+
+    @patch('IndexRunner.BulkBuffer.streaming_bulk')
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def bulk_buffer_test(self, mock_ws, mock_bulk):
+        cfg = self.cfg.copy()
+        cfg['es-bulk'] = 'true'
+        cfg['es-refresh'] = 'none'
+        iu = IndexerUtils(cfg)
+        iu.es = Mock()
+        iu.es.mget.return_value = {'docs': []}
+        iu.ws.get_workspace_info.return_value = self.wsinfo
+        iu.ws.get_objects2.return_value = self.narobj
+        ev1 = self.new_version_event.copy()
+        ev1['objtype'] = 'Blah.Blah'
+        ev2 = ev1.copy()
+        ev2['objid'] = '3'
+        iu.es.get.return_value = {'found': False}
+        # The second event's data document fails
+        err = {'create': {'_index': self._iname('objects'), 'status': 409,
+                          'error': 'exists'}}
+        mock_bulk.return_value = iter([(True, {}), (True, {}), (True, {}),
+                                       (False, err)])
+        failed = iu.process_events([ev1, ev2])
+        # The writes of both events go in one bulk request
+        iu.es.create.assert_not_called()
+        iu.es.index.assert_not_called()
+        mock_bulk.assert_called_once()
+        actions = mock_bulk.call_args[0][1]
+        self.assertEqual([a['_op_type'] for a in actions],
+                         ['index', 'create', 'index', 'create'])
+        self.assertEqual(actions[1]['_parent'], 'WS:1:2:3')
+        self.assertEqual(mock_bulk.call_args[1]['refresh'], 'false')
+        self.assertEqual(len(failed), 1)
+        self.assertIs(failed[0][0], ev2)
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def temp_workspace_test(self, mock_ws):
+        iu = IndexerUtils(self.cfg)
+        iu.es = Mock()
+        iu.es.get.return_value = {'found': False}
+        iu.mr = Mock()
+        iu.ws.get_objects2.return_value = self.genobj
+        ev = self.new_version_event.copy()
+        ev['objtype'] = 'KBaseGenomes.Genome'
+        ev['wsflags'] = {'temp': True, 'public': False, 'shared': False}
+        # Temporary narratives are skipped without running the indexers
+        self.assertTrue(iu.process_event(ev))
+        iu.mr.run.assert_not_called()
+        iu.es.create.assert_not_called()
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def refresh_before_query_test(self, mock_ws):
+        for policy in ['none', 'batch']:
+            cfg = self.cfg.copy()
+            cfg['es-refresh'] = policy
+            iu = IndexerUtils(cfg)
+            iu.es = Mock()
+            iu.es.indices.get.return_value = {self._iname('genome'): {}}
+            ev = self.new_version_event.copy()
+            ev['evtype'] = 'DELETE_ALL_VERSIONS'
+            ev2 = ev.copy()
+            ev2['objid'] = '3'
+            iu.process_events([ev, ev2])
+            # The first event's writes are refreshed before the second
+            # event's delete by query
+            calls = [c[0] for c in iu.es.method_calls
+                     if c[0] in ['indices.refresh', 'delete_by_query']]
+            self.assertEqual(calls[:3], ['delete_by_query', 'indices.refresh',
+                                         'delete_by_query'])
+            self.assertEqual(iu.es.indices.refresh.call_args_list[0][1]['index'],
+                             self._iname('genome'))
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def batch_versions_test(self, mock_ws):
+        iu = IndexerUtils(self.cfg)
+        iu.es = Mock()
+        ev = self.new_version_event.copy()
+        ev['info'] = self.narobj['data'][0]['info']
+        vers = ev['info'][4]
+        index = self._iname('narrative')
+        # One lookup for the batch, not a count per object
+        iu.es.msearch.return_value = {'responses': [
+            {'aggregations': {'latest': {'value': float(vers)}}}]}
+        iu._versions = iu._find_versions([ev, self.new_version_event])
+        iu.es.msearch.assert_called_once()
+        self.assertEqual(len(iu.es.msearch.call_args[1]['body']), 2)
+        self.assertFalse(iu._newer_indexed(index, 1, '2', vers))
+        # A newer version written in the batch counts before it's visible
+        iu._mark_version(index, 1, '2', vers + 1)
+        self.assertTrue(iu._newer_indexed(index, 1, '2', vers))
+        iu.es.count.assert_not_called()
+
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def process_events_error_test(self, mock_ws):
+        iu = IndexerUtils(self.cfg)
+        iu.es = Mock()
+        iu.log = Mock()
+        ev = self.new_version_event.copy()
+        ev['evtype'] = 'PUBLISH_ACCESS_GROUP'
+        iu.ws.get_workspace_info.side_effect = Exception('boom')
+        failed = iu.process_events([ev])
+        self.assertEqual(len(failed), 1)
+        # The traceback is logged with the failure
+        iu.log.exception.assert_called_once()
+        self.assertIn('boom', iu.log.exception.call_args[0][0])
+
+    @patch('IndexRunner.IndexerUtils.Elasticsearch', autospec=True)
+    @patch('IndexRunner.IndexerUtils.WorkspaceAdminUtil', autospec=True)
+    def es_maxsize_test(self, mock_ws, mock_es):
+        cfg = self.cfg.copy()
+        cfg['es-maxsize'] = '50'
+        IndexerUtils(cfg)
+        self.assertEqual(mock_es.call_args[1]['maxsize'], 50)
@@ -3,6 +3,7 @@ import unittest
 import os  # noqa: F401
 import json  # noqa: F401
 from IndexRunner.WSAdminUtils import WorkspaceAdminUtil
+from unittest.mock import patch
 from nose.plugins.attrib import attr
 
 from os import environ
@@ -43,3 +44,29 @@ class WSAdminTester(unittest.TestCase):
         id = '%s/%s' % (self.wsid, ob[0])
         res = ws.get_objects2({'objects': [{'ref': id}]})['data'][0]
         self.assertIsNotNone(res)
+
+    @patch('IndexRunner.WSAdminUtils.Workspace', autospec=True)
+    def iter_pages_test(self, mock_ws):
+        cfg = self.cfg.copy()
+        cfg['workspace-admin-token'] = None
+        ws = WorkspaceAdminUtil(cfg)
+        # Objects 1-25 plus one saved after max_objid was read
+        ids = list(range(1, 26)) + [31]
+
+        def list_objects(params):
+            low = params['minObjectID']
+            high = params.get('maxObjectID', 1000)
+            objs = [[i] for i in ids if i >= low and i <= high]
+            return objs[:params['limit']]
+        mock_ws.return_value.list_objects.side_effect = list_objects
+        mock_ws.return_value.get_workspace_info.return_value = \
+            [1, 'ws', 'user', '', 25, 'a', 'n', 'unlocked', {}]
+        pages = list(ws.iter_pages(1, {'type': 'Blah.Blah'}, chunk_size=10,
+                                   threads=2))
+        self.assertEqual([len(p) for p in pages], [9, 10, 6, 1])
+        # One call per chunk, even for the full one
+        self.assertEqual(mock_ws.return_value.list_objects.call_count, 4)
+        objs = list(ws.iter_objects(1, start=5, max_objid=25, chunk_size=10))
+        self.assertEqual([o[0] for o in objs], ids[4:])
+        params = mock_ws.return_value.list_objects.call_args_list[0][0][0]
+        self.assertEqual(params['type'], 'Blah.Blah')